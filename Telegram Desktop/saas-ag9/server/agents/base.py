@@ -1,11 +1,138 @@
-from typing import Protocol, Dict
+import asyncio
+import functools
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Protocol
+
+from server import metrics as prom
+
+
+AGENT_CALLS_TOTAL = prom.counter("agent_calls_total", "Agent provider calls", ["provider", "call", "outcome"])
+AGENT_CALL_SECONDS = prom.histogram(
+    "agent_call_seconds", "Agent provider call latency", ["provider", "call"],
+    buckets=(0.001, 0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+AGENT_INFLIGHT = prom.gauge("agent_inflight", "Agent provider calls in progress", ["provider"])
 
 
 class AgentProvider(Protocol):
-    def status(self) -> Dict[str, object]:
+    async def status(self) -> Dict[str, object]:
         """Return agent status/health payload."""
         ...
 
-    def respond(self, message: str, lang: str = "en", session_id: str | None = None, tenant_id: str | None = None) -> Dict[str, str]:
+    async def respond(self, message: str, lang: str = "en", session_id: str | None = None, tenant_id: str | None = None) -> Dict[str, str]:
         """Return agent response with at least { reply, lang } keys."""
-        ...
\ No newline at end of file
+        ...
+
+
+class SyncAgentProvider(Protocol):
+    """Blocking providers; wrap them in ``ThreadedAgent`` (``as_async`` does it)."""
+
+    def status(self) -> Dict[str, object]:
+        ...
+
+    def respond(self, message: str, lang: str = "en", session_id: str | None = None, tenant_id: str | None = None) -> Dict[str, str]:
+        ...
+
+
+class AgentUnavailable(RuntimeError):
+    """A call was refused (``reason="busy"``) or ran past its deadline (``reason="timeout"``)."""
+
+    def __init__(self, provider: str, reason: str) -> None:
+        super().__init__(f"agent {provider} {reason}")
+        self.provider = provider
+        self.reason = reason
+
+
+def provider_name(provider: Any) -> str:
+    return getattr(provider, "name", None) or type(provider).__name__
+
+
+class ThreadedAgent:
+    """Runs a blocking provider on its own thread pool so it never stalls the event loop.
+
+    The pool has ``max_workers`` threads, so a slow provider can tie up at
+    most that many threads and never the loop's default executor. A call
+    that is cancelled before its thread picks it up is dropped; one that is
+    already running finishes in the background and its result is discarded.
+    """
+
+    def __init__(self, provider: SyncAgentProvider, max_workers: int = 8) -> None:
+        self.provider = provider
+        self.name = provider_name(provider)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"agent-{self.name}")
+
+    async def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def status(self) -> Dict[str, object]:
+        return await self._call(self.provider.status)
+
+    async def respond(self, message: str, lang: str = "en", session_id: str | None = None, tenant_id: str | None = None) -> Dict[str, str]:
+        return await self._call(self.provider.respond, message, lang=lang, session_id=session_id, tenant_id=tenant_id)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class LimitedAgent:
+    """Bounds how many calls run against a provider at once and how long each may take.
+
+    A call waits at most ``queue_timeout`` seconds for one of the
+    ``max_concurrency`` slots and then gets ``timeout`` seconds to finish;
+    past either deadline it is cancelled and ``AgentUnavailable`` is raised,
+    so one slow upstream cannot pile up requests without bound.
+    """
+
+    def __init__(self, provider: AgentProvider, max_concurrency: int = 16, timeout: float = 10.0, queue_timeout: float = 2.0) -> None:
+        self.provider = provider
+        self.name = provider_name(provider)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    async def _call(self, call: str, fn, *args, **kwargs):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            prom.inc(AGENT_CALLS_TOTAL, provider=self.name, call=call, outcome="busy")
+            raise AgentUnavailable(self.name, "busy") from None
+        prom.inc(AGENT_INFLIGHT, provider=self.name)
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await asyncio.wait_for(fn(*args, **kwargs), self.timeout)
+            outcome = "ok"
+            return result
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise AgentUnavailable(self.name, "timeout") from None
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            self._slots.release()
+            prom.dec(AGENT_INFLIGHT, provider=self.name)
+            prom.inc(AGENT_CALLS_TOTAL, provider=self.name, call=call, outcome=outcome)
+            prom.observe(AGENT_CALL_SECONDS, time.perf_counter() - start, provider=self.name, call=call)
+
+    async def status(self) -> Dict[str, object]:
+        return await self._call("status", self.provider.status)
+
+    async def respond(self, message: str, lang: str = "en", session_id: str | None = None, tenant_id: str | None = None) -> Dict[str, str]:
+        return await self._call("respond", self.provider.respond, message, lang=lang, session_id=session_id, tenant_id=tenant_id)
+
+    def close(self) -> None:
+        close = getattr(self.provider, "close", None)
+        if close is not None:
+            close()
+
+
+def as_async(provider: Any, max_workers: int = 8) -> AgentProvider:
+    """Return ``provider`` if it already implements the async protocol, else a ``ThreadedAgent``."""
+    if inspect.iscoroutinefunction(provider.respond) and inspect.iscoroutinefunction(provider.status):
+        return provider
+    return ThreadedAgent(provider, max_workers=max_workers)
@@ -1,7 +1,8 @@
 import os
 from typing import Dict
 from datetime import datetime
-import requests
+
+from server.http_client import http_client
 
 
 def now_iso() -> str:
@@ -26,22 +27,22 @@ class FetchAgent:
         if not self.base:
             raise RuntimeError("FETCH_AGENT_ENDPOINT not configured")
 
-    def status(self) -> Dict[str, object]:
+    async def status(self) -> Dict[str, object]:
         self._ensure_configured()
         try:
-            r = requests.get(f"{self.base}/status", timeout=6)
-            if r.ok:
+            r = await http_client("fetch_agent").get(f"{self.base}/status", timeout=6)
+            if r.is_success:
                 return r.json()
             return {"healthy": False, "error": f"status {r.status_code}", "time": now_iso()}
         except Exception as e:
             return {"healthy": False, "error": str(e), "time": now_iso()}
 
-    def respond(self, message: str, lang: str = "en", session_id: str | None = None, tenant_id: str | None = None) -> Dict[str, str]:
+    async def respond(self, message: str, lang: str = "en", session_id: str | None = None, tenant_id: str | None = None) -> Dict[str, str]:
         self._ensure_configured()
         payload = {"message": message, "lang": lang, "session_id": session_id, "tenant_id": tenant_id}
         try:
-            r = requests.post(f"{self.base}/respond", json=payload, timeout=8)
-            if r.ok:
+            r = await http_client("fetch_agent").post(f"{self.base}/respond", json=payload)
+            if r.is_success:
                 data = r.json()
                 return {"reply": data.get("reply", ""), "lang": data.get("lang", lang or "en")}
             return {"reply": f"Remote agent error ({r.status_code}).", "lang": lang or "en"}
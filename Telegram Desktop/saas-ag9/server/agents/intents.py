@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Iterable
+
+
+INTENTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intents.json")
+NO_MATCH = sys.maxsize
+# Below this many keywords per language a chain of ``in`` checks beats the
+# automaton (measured with ``python -m server.agents.intents``).
+AUTOMATON_MIN_KEYWORDS = 100
+
+
+class AhoCorasick:
+    """Multi-pattern substring matcher that reports the lowest-ranked hit.
+
+    Patterns are compiled into a trie whose failure links are folded into
+    the transitions, so ``first`` costs one dict lookup per character of
+    the text however many patterns there are. ``best[n]`` is the lowest
+    rank of any pattern ending at node ``n`` or along its failure chain.
+    """
+
+    def __init__(self, patterns: Iterable[tuple[str, int]]) -> None:
+        goto: list[dict[str, int]] = [{}]
+        best = [NO_MATCH]
+        for pattern, rank in patterns:
+            if not pattern:
+                continue
+            node = 0
+            for ch in pattern:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = goto[node][ch] = len(goto)
+                    goto.append({})
+                    best.append(NO_MATCH)
+                node = nxt
+            best[node] = min(best[node], rank)
+        fail = [0] * len(goto)
+        delta = [dict(edges) for edges in goto]
+        order = [0]
+        for node in order:
+            for ch, child in goto[node].items():
+                if node:
+                    fail[child] = delta[fail[node]].get(ch, 0)
+                best[child] = min(best[child], best[fail[child]])
+                order.append(child)
+            if node:
+                # Breadth-first order means the failure node is already complete.
+                for ch, target in delta[fail[node]].items():
+                    delta[node].setdefault(ch, target)
+        self.delta = delta
+        self.best = best
+
+    def __len__(self) -> int:
+        return len(self.delta)
+
+    def first(self, text: str) -> int:
+        """Lowest rank of any pattern occurring in ``text``, or ``NO_MATCH``."""
+        delta, best = self.delta, self.best
+        node = 0
+        found = NO_MATCH
+        for ch in text:
+            node = delta[node].get(ch, 0)
+            if best[node] < found:
+                found = best[node]
+                if not found:
+                    break
+        return found
+
+
+class IntentTable:
+    """Ordered intents for one language, compiled for matching.
+
+    Intents keep their file order as priority: when keywords of several
+    intents occur in a message the earliest intent wins, exactly as a chain
+    of ``if keyword in message`` checks would. Tables with at least
+    ``AUTOMATON_MIN_KEYWORDS`` keywords are compiled into one automaton that
+    scans the message once; below that the chain of ``in`` checks, each of
+    which runs in C, is faster and is used as is.
+    """
+
+    def __init__(self, spec: dict) -> None:
+        intents = spec.get("intents", [])
+        self.intents = [(i["name"], i["reply"]) for i in intents]
+        self.fallback = spec.get("fallback", "")
+        self.keywords = [[kw.lower() for kw in i.get("keywords", []) if kw] for i in intents]
+        self.automaton = None
+        if sum(map(len, self.keywords)) >= AUTOMATON_MIN_KEYWORDS:
+            self.automaton = AhoCorasick((kw, rank) for rank, kws in enumerate(self.keywords) for kw in kws)
+
+    def rank(self, message: str) -> int:
+        if self.automaton is not None:
+            return self.automaton.first(message)
+        for rank, kws in enumerate(self.keywords):
+            for kw in kws:
+                if kw in message:
+                    return rank
+        return NO_MATCH
+
+    def match(self, message: str) -> tuple[str | None, str]:
+        """Return ``(intent name or None, reply)`` for an already lower-cased message."""
+        rank = self.rank(message)
+        if rank == NO_MATCH:
+            return None, self.fallback
+        return self.intents[rank]
+
+
+class IntentMatcher:
+    """Per-language intent tables loaded from a JSON file and reloaded when it changes.
+
+    The file's mtime is checked at most every ``check_interval`` seconds; a
+    file that fails to load is logged and the previous tables stay in use.
+    """
+
+    def __init__(self, path: str, check_interval: float = 2.0) -> None:
+        self.path = path
+        self.check_interval = check_interval
+        self.spec: dict = {}
+        self.tables: dict[str, IntentTable] = {}
+        self._mtime = 0.0
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> bool:
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, encoding="utf-8") as f:
+                spec = json.load(f)
+            tables = {lang: IntentTable(s) for lang, s in spec.items()}
+        except Exception as e:
+            logging.warning(f"intent table {self.path} not loaded: {e}")
+            return False
+        self.spec, self.tables, self._mtime = spec, tables, mtime
+        return True
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if now - self._checked < self.check_interval:
+                return
+            self._checked = now
+            try:
+                changed = os.stat(self.path).st_mtime != self._mtime
+            except OSError:
+                return
+            if changed:
+                self.reload()
+
+    def match(self, message: str, lang: str | None = None) -> tuple[str | None, str]:
+        """Match ``message`` against the table for ``lang``: ``en*`` is English, anything else Thai."""
+        self._maybe_reload()
+        table = self.tables.get("en" if (lang or "").startswith("en") else "th")
+        if table is None:
+            return None, ""
+        return table.match((message or "").strip().lower())
+
+
+INTENTS = IntentMatcher((os.getenv("AGENT_INTENTS_FILE") or "").strip() or INTENTS_PATH)
+
+
+def _benchmark(synthetic: int = 200, seconds: float = 2.0) -> None:
+    """Report messages/s for the automaton vs. the chain of ``in`` checks.
+
+    Runs once on the loaded intent file and once on ``synthetic`` generated
+    intents, to show how each approach scales with the size of the table.
+    """
+    import random
+    random.seed(0)
+
+    def word(alphabet: str) -> str:
+        return "".join(random.choices(alphabet, k=random.randint(4, 9)))
+
+    latin = "abcdefghijklmnopqrstuvwxyz"
+    generated = {
+        "intents": [{"name": f"intent{n}", "keywords": [word(latin) for _ in range(5)], "reply": str(n)} for n in range(synthetic)],
+        "fallback": "",
+    }
+    suites = [(f"{lang} file", spec) for lang, spec in INTENTS.spec.items()] + [(f"synthetic x{synthetic}", generated)]
+    for label, spec in suites:
+        keywords = [kw.lower() for i in spec["intents"] for kw in i["keywords"]]
+        alphabet = "".join(sorted(set("".join(keywords)) | set(latin)))
+        messages = []
+        for _ in range(3000):
+            words = [word(alphabet) for _ in range(random.randint(3, 30))]
+            if keywords and random.random() < 0.7:
+                words.insert(random.randrange(len(words) + 1), random.choice(keywords))
+            messages.append(" ".join(words))
+        chain = IntentTable(spec)
+        chain.automaton = None
+        automaton = IntentTable(spec)
+        automaton.automaton = AhoCorasick((kw, rank) for rank, kws in enumerate(automaton.keywords) for kw in kws)
+        for name, table in (("chain", chain), ("automaton", automaton)):
+            n = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < seconds:
+                for text in messages:
+                    table.match(text.strip().lower())
+                n += len(messages)
+            elapsed = time.perf_counter() - start
+            print(f"{label}: {name} intents={len(spec['intents'])} keywords={len(keywords)} "
+                  f"messages={n} throughput={n / elapsed:,.0f} msg/s")
+
+
+if __name__ == "__main__":
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
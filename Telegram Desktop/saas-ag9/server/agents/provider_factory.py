@@ -1,6 +1,6 @@
 import os
-from typing import Any
 
+from .base import AgentProvider, LimitedAgent, as_async
 from .local_agent import RuleBasedAgent
 
 try:
@@ -9,9 +9,30 @@ except Exception:
     FetchAgent = None
 
 
-def get_agent_provider() -> Any:
+def _float_env(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name) or default)
+    except ValueError:
+        return default
+
+
+def get_agent_provider() -> AgentProvider:
+    """Selected provider behind the async protocol, a concurrency limit and deadlines.
+
+    Tuned with AGENT_MAX_CONCURRENCY, AGENT_TIMEOUT_SECONDS and
+    AGENT_QUEUE_TIMEOUT_SECONDS. Blocking providers run on their own
+    thread pool sized to the concurrency limit.
+    """
     provider = (os.getenv("AGENT_PROVIDER") or "local").strip().lower()
     if provider == "fetch" and FetchAgent is not None:
-        return FetchAgent()
-    # default fallback
-    return RuleBasedAgent()
\ No newline at end of file
+        agent = FetchAgent()
+    else:
+        # default fallback
+        agent = RuleBasedAgent()
+    concurrency = max(1, int(_float_env("AGENT_MAX_CONCURRENCY", 16)))
+    return LimitedAgent(
+        as_async(agent, max_workers=concurrency),
+        max_concurrency=concurrency,
+        timeout=_float_env("AGENT_TIMEOUT_SECONDS", 10.0),
+        queue_timeout=_float_env("AGENT_QUEUE_TIMEOUT_SECONDS", 2.0),
+    )
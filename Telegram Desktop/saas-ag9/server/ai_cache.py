@@ -0,0 +1,149 @@
+import asyncio
+import contextlib
+import hashlib
+from typing import AsyncIterator, Callable
+
+from server import metrics as prom
+from server.ai_relay import StreamResult
+from server.cache import TTLCache
+
+
+AI_CACHE_LOOKUPS = prom.counter("ai_cache_lookups_total", "AI stream cache lookups", ["result"])
+AI_CACHE_BYTES = prom.gauge("ai_cache_bytes", "Bytes of SSE events held by the AI stream cache")
+
+
+class StreamFanout:
+    """A single upstream stream shared by every subscriber that joins it.
+
+    Events are recorded as they arrive, so late subscribers replay from the
+    start and then follow live. The upstream is read at most ``max_lag``
+    events ahead of the slowest subscriber, so slow readers slow it down
+    instead of it being drained into memory. A subscriber counts from its
+    first read until it ends; when the last one leaves before the stream
+    finishes, the upstream is cancelled and the fanout is marked abandoned.
+    """
+
+    def __init__(self, source: AsyncIterator[bytes], on_close: Callable[["StreamFanout"], None], max_lag: int = 256) -> None:
+        self.events: list[bytes] = []
+        self.nbytes = 0
+        self.finished = False
+        self.abandoned = False
+        self.max_lag = max_lag
+        self._source = source
+        self._on_close = on_close
+        self._cond = asyncio.Condition()
+        self._task: asyncio.Task | None = None
+        self._closed = False
+        # Next event index per active subscriber.
+        self._positions: dict[object, int] = {}
+        self._pump_waiting = False
+
+    def _lag(self) -> int:
+        return len(self.events) - min(self._positions.values(), default=len(self.events))
+
+    async def _pump(self) -> None:
+        try:
+            async for chunk in self._source:
+                self.events.append(chunk)
+                self.nbytes += len(chunk)
+                async with self._cond:
+                    self._cond.notify_all()
+                    if self._lag() >= self.max_lag:
+                        self._pump_waiting = True
+                        await self._cond.wait_for(lambda: self._lag() < self.max_lag)
+                        self._pump_waiting = False
+            self.finished = True
+        finally:
+            await self._source.aclose()
+            if not self.abandoned:
+                self._on_close(self)
+            self._closed = True
+            async with self._cond:
+                self._cond.notify_all()
+
+    async def join(self) -> AsyncIterator[bytes]:
+        """Stream every event from the start, then follow live until the upstream ends."""
+        token = object()
+        self._positions[token] = 0
+        if self._task is None:
+            self._task = asyncio.create_task(self._pump())
+        i = 0
+        try:
+            while True:
+                if i < len(self.events):
+                    yield self.events[i]
+                    i += 1
+                    self._positions[token] = i
+                    if self._pump_waiting:
+                        async with self._cond:
+                            self._cond.notify_all()
+                    continue
+                if self._closed:
+                    return
+                async with self._cond:
+                    await self._cond.wait_for(lambda: i < len(self.events) or self._closed)
+        finally:
+            del self._positions[token]
+            if not self._positions and not self._closed:
+                # Nobody is listening any more: detach first so no new caller joins, then stop upstream.
+                self.abandoned = True
+                self._on_close(self)
+                self._task.cancel()
+            elif self._pump_waiting:
+                # The slowest reader may have been this one.
+                async with self._cond:
+                    self._cond.notify_all()
+
+
+async def _replay(events: tuple[bytes, ...]) -> AsyncIterator[bytes]:
+    for chunk in events:
+        yield chunk
+
+
+class PromptCache:
+    """Caches complete SSE event sequences and coalesces identical in-flight prompts."""
+
+    def __init__(self, ttl: float = 3600.0, max_bytes: int = 64 * 1024 * 1024, max_entries: int = 10000) -> None:
+        self.cache = TTLCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+        self.inflight: dict[str, StreamFanout] = {}
+
+    @staticmethod
+    def key(provider: str, model: str, prompt: str) -> str:
+        normalized = " ".join(prompt.split())
+        return f"{provider}:{model}:" + hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def open(self, key: str, factory: Callable[[StreamResult], AsyncIterator[bytes]]) -> tuple[str, AsyncIterator[bytes]]:
+        """Return (cache status, stream) for ``key``, starting ``factory`` only on a miss."""
+        events = self.cache.get(key)
+        if events is not None:
+            prom.inc(AI_CACHE_LOOKUPS, result="hit")
+            return "HIT", _replay(events)
+        fan = self.inflight.get(key)
+        if fan is not None:
+            prom.inc(AI_CACHE_LOOKUPS, result="coalesced")
+            return "COALESCED", self._subscribe(key, fan, factory)
+        prom.inc(AI_CACHE_LOOKUPS, result="miss")
+        return "MISS", self._subscribe(key, None, factory)
+
+    def _start(self, key: str, factory: Callable[[StreamResult], AsyncIterator[bytes]]) -> StreamFanout:
+        result = StreamResult()
+
+        def close(f: StreamFanout) -> None:
+            if self.inflight.get(key) is f:
+                del self.inflight[key]
+            if f.finished and not f.abandoned and result.ok:
+                self.cache.set(key, tuple(f.events), size=f.nbytes)
+                prom.set_value(AI_CACHE_BYTES, self.cache.nbytes)
+
+        fan = self.inflight[key] = StreamFanout(factory(result), close)
+        return fan
+
+    async def _subscribe(self, key: str, fan: StreamFanout | None, factory: Callable[[StreamResult], AsyncIterator[bytes]]) -> AsyncIterator[bytes]:
+        # Nothing is started or registered until the caller first reads, so a
+        # stream handed out but never read cannot keep an upstream alive. A
+        # shared stream abandoned in the meantime is replaced by a fresh one.
+        if fan is None or fan.abandoned:
+            fan = self.inflight.get(key) or self._start(key, factory)
+        async with contextlib.aclosing(fan.join()) as stream:
+            async for chunk in stream:
+                yield chunk
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import AsyncIterator
+
+from server import metrics as prom
+from server.http_client import http_client
+
+
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+
+AI_STREAM_TTFT_SECONDS = prom.histogram(
+    "ai_stream_ttft_seconds", "Time from upstream request to first content token", ["provider", "model"],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30),
+)
+AI_STREAM_TOKENS_PER_SECOND = prom.histogram(
+    "ai_stream_tokens_per_second", "Completion tokens per second after the first token", ["provider", "model"],
+    buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 400),
+)
+AI_STREAMS_TOTAL = prom.counter("ai_streams_total", "Relayed AI streams by outcome", ["provider", "outcome"])
+AI_STREAMS_ACTIVE = prom.gauge("ai_streams_active", "AI streams currently being relayed", ["provider"])
+
+
+def sse_format(data: str) -> bytes:
+    return ("data: " + data + "\n\n").encode("utf-8")
+
+
+class StreamResult:
+    """Outcome and timings of one relayed stream, filled in as it runs."""
+
+    def __init__(self) -> None:
+        self.outcome = "pending"
+        self.ttft: float | None = None
+        # Completion tokens: the upstream's usage count, else estimated from the streamed text.
+        self.tokens = 0
+        self.duration = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.outcome == "ok"
+
+
+async def echo_stream(prompt: str, result: StreamResult | None = None) -> AsyncIterator[bytes]:
+    """Placeholder stream for providers without a configured upstream."""
+    for w in prompt.split():
+        yield sse_format(w)
+        await asyncio.sleep(0.05)
+    yield sse_format("[DONE]")
+    if result is not None:
+        result.outcome = "ok"
+
+
+# Rough tokens per character of English text, used when the upstream sends no usage.
+TOKENS_PER_CHAR = 0.25
+
+
+def _parse_line(line: str) -> tuple[str, int | None]:
+    """Return ``(content text, completion tokens from usage or None)`` for one SSE line."""
+    if not line.startswith("data: ") or line == "data: [DONE]":
+        return "", None
+    try:
+        obj = json.loads(line[6:])
+    except ValueError:
+        return "", None
+    text = "".join((c.get("delta") or {}).get("content") or "" for c in obj.get("choices") or [])
+    usage = obj.get("usage") or {}
+    return text, usage.get("completion_tokens")
+
+
+async def openai_stream(prompt: str, model: str, result: StreamResult | None = None, metric_model: str = "other") -> AsyncIterator[bytes]:
+    """Relay an OpenAI chat completion stream as SSE.
+
+    Chunks are forwarded as they arrive and the next upstream read only
+    happens once the client has taken the previous one, so a slow client
+    applies backpressure instead of buffering. When the client disconnects
+    Starlette cancels this generator and leaving the ``stream`` context
+    closes the upstream connection.
+
+    ``metric_model`` is the ``model`` label for the latency histograms; it
+    defaults to ``"other"`` so request-supplied names never become labels.
+    """
+    key = os.getenv("OPENAI_API_KEY")
+    if not key:
+        async for chunk in echo_stream(prompt, result):
+            yield chunk
+        return
+    headers = {"Authorization": f"Bearer {key}", "Content-Type": "application/json"}
+    # include_usage adds a final chunk carrying the completion's token count.
+    body = {"model": model, "messages": [{"role": "user", "content": prompt}], "stream": True, "stream_options": {"include_usage": True}}
+    start = time.perf_counter()
+    first = None
+    chars = 0
+    usage_tokens = None
+    outcome = "ok"
+    prom.inc(AI_STREAMS_ACTIVE, provider="openai")
+    try:
+        async with http_client("openai").stream("POST", OPENAI_CHAT_URL, headers=headers, json=body) as r:
+            if r.status_code != 200:
+                detail = (await r.aread())[:200]
+                logging.warning(f"openai stream upstream status={r.status_code} body={detail!r}")
+                outcome = "upstream_error"
+                yield sse_format("error")
+                yield sse_format("[DONE]")
+                return
+            async for line in r.aiter_lines():
+                if not line:
+                    continue
+                text, usage = _parse_line(line)
+                if usage is not None:
+                    usage_tokens = usage
+                if text:
+                    if first is None:
+                        first = time.perf_counter()
+                        prom.observe(AI_STREAM_TTFT_SECONDS, first - start, provider="openai", model=metric_model)
+                    chars += len(text)
+                yield line.encode("utf-8") + b"\n\n"
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        logging.warning(f"openai stream failed: {e}")
+        outcome = "error"
+        yield sse_format("error")
+        yield sse_format("[DONE]")
+    finally:
+        end = time.perf_counter()
+        tokens = usage_tokens if usage_tokens is not None else round(chars * TOKENS_PER_CHAR)
+        prom.dec(AI_STREAMS_ACTIVE, provider="openai")
+        prom.inc(AI_STREAMS_TOTAL, provider="openai", outcome=outcome)
+        if first is not None and tokens > 1 and end > first:
+            prom.observe(AI_STREAM_TOKENS_PER_SECOND, tokens / (end - first), provider="openai", model=metric_model)
+        if result is not None:
+            result.outcome = outcome
+            result.ttft = None if first is None else first - start
+            result.tokens = tokens
+            result.duration = end - start
+
+
+# Providers relayed to a real upstream. Anything else is served by
+# ``echo_stream`` and produces no timings, so it must not be routed to.
+RELAYS = {"openai": openai_stream}
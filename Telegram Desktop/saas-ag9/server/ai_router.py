@@ -0,0 +1,200 @@
+import random
+import time
+from typing import AsyncIterator, Callable
+
+from server import metrics as prom
+from server.ai_relay import RELAYS, StreamResult
+
+
+# Price per 1k tokens for known (provider, model) pairs.
+PRICES: dict[tuple[str, str], float] = {
+    ("openai", "gpt-4o-mini"): 0.005,
+    ("anthropic", "claude-3-haiku"): 0.008,
+    ("google", "gemini-1.5-flash"): 0.002,
+}
+# Only models with a relayed upstream are routable; the rest would never be measured.
+DEFAULT_CATALOG: dict[tuple[str, str], float] = {k: v for k, v in PRICES.items() if k[0] in RELAYS}
+
+AI_ROUTER_TTFT = prom.gauge("ai_router_ttft_seconds", "Rolling time to first token per model", ["provider", "model"])
+AI_ROUTER_TPS = prom.gauge("ai_router_tokens_per_second", "Rolling completion tokens per second per model", ["provider", "model"])
+AI_ROUTER_ERROR_RATE = prom.gauge("ai_router_error_rate", "Rolling upstream error rate per model", ["provider", "model"])
+AI_ROUTER_CIRCUIT_OPEN = prom.gauge("ai_router_circuit_open", "1 while a model's circuit breaker is open", ["provider", "model"])
+
+
+class ModelStats:
+    """Exponentially weighted stats and circuit breaker state for one model."""
+
+    def __init__(self, provider: str, model: str, price: float, ttft: float, tps: float) -> None:
+        self.provider = provider
+        self.model = model
+        self.price = price
+        self.ttft = ttft
+        self.tps = tps
+        self.error_rate = 0.0
+        self.samples = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.probe_until = 0.0
+        self.explore_until = 0.0
+
+    def available(self, now: float) -> bool:
+        """Closed breakers pass; an open one lets a single probe through after its cooldown."""
+        if self.open_until == 0.0:
+            return True
+        return now >= self.open_until and now >= self.probe_until
+
+    def expected_seconds(self, max_tokens: int) -> float:
+        return self.ttft + max_tokens / max(self.tps, 1e-3)
+
+    def snapshot(self, now: float) -> dict:
+        return {
+            "provider": self.provider,
+            "model": self.model,
+            "price_per_1k": self.price,
+            "ttft_seconds": round(self.ttft, 4),
+            "tokens_per_second": round(self.tps, 2),
+            "error_rate": round(self.error_rate, 4),
+            "samples": self.samples,
+            "circuit": "closed" if self.open_until == 0.0 else ("half_open" if now >= self.open_until else "open"),
+        }
+
+
+class ProviderRouter:
+    """Chooses a provider/model from rolling stats of real ``/ai/stream`` traffic.
+
+    ``cost`` priority minimises price per successful call and ``speed``
+    minimises expected time to finish ``max_tokens`` (first-token latency
+    plus streaming time), both inflated by the observed error rate. A model
+    whose streams fail ``failure_threshold`` times in a row is skipped for
+    ``cooldown`` seconds, then a single probe request decides whether it
+    rejoins the pool.
+
+    A model with fewer than ``min_samples`` recorded streams is not ranked
+    on the priors: it is sent one exploration request at a time (held for
+    ``cooldown`` if the stream never reports) until it has been measured,
+    and afterwards ``explore_rate`` of requests go to a random other
+    available model so the stats of models that are not winning stay fresh.
+    """
+
+    def __init__(
+        self,
+        catalog: dict[tuple[str, str], float] | None = None,
+        alpha: float = 0.2,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        prior_ttft: float = 1.0,
+        prior_tps: float = 50.0,
+        min_samples: int = 3,
+        explore_rate: float = 0.05,
+    ) -> None:
+        self.alpha = alpha
+        self.min_samples = max(1, min_samples)
+        self.explore_rate = explore_rate
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.prior_ttft = prior_ttft
+        self.prior_tps = prior_tps
+        # Only catalogued models are tracked: request-supplied names must not
+        # become routable (with no known price) or grow the stats and labels.
+        self.stats: dict[tuple[str, str], ModelStats] = {
+            (provider, model): ModelStats(provider, model, price, prior_ttft, prior_tps)
+            for (provider, model), price in (catalog or DEFAULT_CATALOG).items()
+        }
+
+    def routable(self, provider: str, model: str) -> bool:
+        return (provider, model) in self.stats
+
+    def _ewma(self, old: float, new: float, samples: int) -> float:
+        # The first sample replaces the prior outright.
+        return new if samples == 0 else old + self.alpha * (new - old)
+
+    def record(self, provider: str, model: str, result: StreamResult) -> None:
+        """Fold a finished stream into the model's stats.
+
+        Client cancellations, streams that never reached an upstream
+        (placeholder echo) and models outside the catalog are ignored.
+        """
+        s = self.stats.get((provider, model))
+        if s is None or result.outcome in ("pending", "cancelled") or (result.ok and result.ttft is None):
+            return
+        failed = not result.ok
+        s.error_rate = self._ewma(s.error_rate, 1.0 if failed else 0.0, s.samples)
+        if not failed:
+            s.ttft = self._ewma(s.ttft, result.ttft, s.samples)
+            streaming = result.duration - result.ttft
+            if result.tokens > 1 and streaming > 0:
+                s.tps = self._ewma(s.tps, result.tokens / streaming, s.samples)
+        s.samples += 1
+        s.probe_until = 0.0
+        s.explore_until = 0.0
+        if failed:
+            s.failures += 1
+            if s.failures >= self.failure_threshold or s.open_until:
+                s.open_until = time.monotonic() + self.cooldown
+        else:
+            s.failures = 0
+            s.open_until = 0.0
+        labels = {"provider": provider, "model": model}
+        prom.set_value(AI_ROUTER_TTFT, s.ttft, **labels)
+        prom.set_value(AI_ROUTER_TPS, s.tps, **labels)
+        prom.set_value(AI_ROUTER_ERROR_RATE, s.error_rate, **labels)
+        prom.set_value(AI_ROUTER_CIRCUIT_OPEN, 1 if s.open_until else 0, **labels)
+
+    def _score(self, s: ModelStats, priority: str, max_tokens: int) -> tuple[float, float]:
+        success = max(1.0 - s.error_rate, 0.05)
+        if priority == "speed":
+            return s.expected_seconds(max_tokens) / success, s.price
+        return s.price / success, s.expected_seconds(max_tokens)
+
+    def choose(self, priority: str | None = "cost", allow: list[str] | None = None, max_tokens: int = 2048) -> tuple[str, str, str]:
+        """Return ``(provider, model, reason)`` for the best available model."""
+        now = time.monotonic()
+        allowed = {p.lower() for p in allow} if allow else None
+        candidates = [s for s in self.stats.values() if allowed is None or s.provider in allowed]
+        if not candidates:
+            return "openai", "gpt-4o-mini", "default"
+        priority = priority if priority in ("cost", "speed") else "cost"
+        open_ = [s for s in candidates if s.available(now)]
+        if not open_:
+            # Everything is tripped: use whichever breaker reopens first rather than failing outright.
+            s = min(candidates, key=lambda c: c.open_until)
+            return s.provider, s.model, "all_circuits_open"
+        unmeasured = [c for c in open_ if c.samples < self.min_samples]
+        waiting = [c for c in unmeasured if now >= c.explore_until]
+        if waiting:
+            # Measure before ranking: one request at a time, fewest samples first.
+            s = min(waiting, key=lambda c: (c.samples, self._score(c, priority, max_tokens)))
+            s.explore_until = now + self.cooldown
+            return s.provider, s.model, f"{priority}:explore"
+        measured = [c for c in open_ if c.samples >= self.min_samples] or open_
+        s = min(measured, key=lambda c: self._score(c, priority, max_tokens))
+        others = [c for c in measured if c is not s]
+        if others and not s.open_until and random.random() < self.explore_rate:
+            s = random.choice(others)
+            return s.provider, s.model, f"{priority}:explore"
+        if s.open_until:
+            # Hold other traffic back while the probe runs; if it never reports, allow another after a cooldown.
+            s.probe_until = now + self.cooldown
+            return s.provider, s.model, f"{priority}:probe"
+        return s.provider, s.model, f"{priority}:{'live' if s.samples >= self.min_samples else 'prior'}"
+
+    def track(self, provider: str, model: str, factory: Callable[[StreamResult | None], AsyncIterator[bytes]]) -> Callable[[StreamResult | None], AsyncIterator[bytes]]:
+        """Wrap a stream factory so every stream it starts is recorded when it ends."""
+
+        def start(result: StreamResult | None = None) -> AsyncIterator[bytes]:
+            result = result if result is not None else StreamResult()
+
+            async def run() -> AsyncIterator[bytes]:
+                try:
+                    async for chunk in factory(result):
+                        yield chunk
+                finally:
+                    self.record(provider, model, result)
+
+            return run()
+
+        return start
+
+    def snapshot(self) -> list[dict]:
+        now = time.monotonic()
+        return [s.snapshot(now) for s in self.stats.values()]
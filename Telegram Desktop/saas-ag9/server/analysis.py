@@ -0,0 +1,314 @@
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+from collections import Counter, deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterable, Iterable
+
+from server.sketch import SpaceSaving
+from server.thai_segmenter import SEGMENTER, ThaiSegmenter
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int((os.getenv(name) or "").strip() or default)
+    except ValueError:
+        return default
+
+
+EN_STOPWORDS = frozenset({
+    "the","a","an","and","or","but","if","then","else","on","in","at","to","for","from","of","with","without","by","as","is","are","was","were","be","been","this","that","these","those","it","its","we","our","you","your","i","me","my","they","them","their","he","she","his","her","not"
+})
+
+_SENTENCE_RE = re.compile(r"[^\.!?\u2026\n]+")
+# Group 1 is a Thai run, group 2 an English token (letters and apostrophes).
+_RUN_RE = re.compile(r"([\u0E00-\u0E7F]+)|([A-Za-z']+)")
+
+
+def bigrams(tokens: list[str]) -> list[str]:
+    return [tokens[i] + ' ' + tokens[i+1] for i in range(len(tokens)-1)]
+
+
+class MixedTokenizer:
+    """Classifies a sentence and extracts EN/TH tokens in a single regex scan.
+
+    Each match of the combined pattern is a maximal Thai run or an English
+    token, so script detection, language switches and tokenization all come
+    out of the same walk over the sentence. Thai runs are then split into
+    words by the dictionary segmenter.
+    """
+
+    def __init__(self, stopwords: Iterable[str] = EN_STOPWORDS, segmenter: ThaiSegmenter | None = None) -> None:
+        self.stopwords = frozenset(stopwords)
+        self.segmenter = segmenter or SEGMENTER
+
+    def sentences(self, text: str) -> list[str]:
+        out = []
+        for m in _SENTENCE_RE.finditer(text):
+            s = m.group().strip()
+            if s:
+                out.append(s)
+        return out
+
+    def _thai_tokens(self, runs: list[str]) -> list[str]:
+        segment = self.segmenter.segment
+        out: list[str] = []
+        for run in runs:
+            out.extend(segment(run))
+        return out
+
+    def tokenize(self, sentence: str) -> tuple[str, list[str], list[str], int]:
+        """Return (lang, en_tokens, th_tokens, switches) for one sentence."""
+        sw = self.stopwords
+        en_toks: list[str] = []
+        th_runs: list[str] = []
+        has_en = False
+        prev = None
+        switches = 0
+        for m in _RUN_RE.finditer(sentence):
+            th = m.group(1)
+            if th is not None:
+                th_runs.append(th)
+                script = "th"
+            else:
+                tok = m.group(2).lower()
+                if len(tok) > 1 and tok not in sw:
+                    en_toks.append(tok)
+                if not tok.strip("'"):
+                    continue
+                has_en = True
+                script = "en"
+            if prev is not None and script != prev:
+                switches += 1
+            prev = script
+        if th_runs and has_en:
+            return "mixed", en_toks, self._thai_tokens(th_runs), switches
+        if th_runs:
+            return "th", [], self._thai_tokens(th_runs), 0
+        return "en", en_toks, [], 0
+
+
+TOKENIZER = MixedTokenizer()
+
+
+class MixedCounters:
+    """Term, phrase and mixing counters accumulated over a stream of texts.
+
+    With ``sketch_width`` set, term and phrase counts are kept in fixed-size
+    Space-Saving summaries instead of exact Counters, so memory no longer
+    grows with vocabulary.
+    """
+
+    def __init__(self, tokenizer: MixedTokenizer | None = None, sketch_width: int | None = None) -> None:
+        self.tokenizer = tokenizer or TOKENIZER
+        self.sketch_width = sketch_width
+        make = (lambda: SpaceSaving(sketch_width)) if sketch_width else Counter
+        self.en_terms = make()
+        self.th_terms = make()
+        self.en_phr = make()
+        self.th_phr = make()
+        self.patterns: Counter = Counter()
+        self.sentences = {"en":0,"th":0,"mixed":0}
+        self.switches = 0
+
+    def add_text(self, text: str) -> None:
+        tokenize = self.tokenizer.tokenize
+        for s in self.tokenizer.sentences(text or ""):
+            lang, en_t, th_t, sw = tokenize(s)
+            self.sentences[lang] += 1
+            if en_t:
+                self.en_terms.update(en_t)
+                if len(en_t) > 1:
+                    self.en_phr.update(bigrams(en_t))
+            if th_t:
+                self.th_terms.update(th_t)
+                if len(th_t) > 1:
+                    self.th_phr.update(bigrams(th_t))
+            if lang == "mixed":
+                self.switches += sw
+                if en_t and th_t:
+                    self.patterns['TH→EN'] += 1
+                    self.patterns['EN→TH'] += 1
+
+    def add_texts(self, texts: Iterable[str]) -> "MixedCounters":
+        for t in texts:
+            self.add_text(t)
+        return self
+
+    def merge(self, other: "MixedCounters") -> "MixedCounters":
+        self.en_terms.update(other.en_terms)
+        self.th_terms.update(other.th_terms)
+        self.en_phr.update(other.en_phr)
+        self.th_phr.update(other.th_phr)
+        self.patterns.update(other.patterns)
+        for k, v in other.sentences.items():
+            self.sentences[k] = self.sentences.get(k, 0) + v
+        self.switches += other.switches
+        return self
+
+    def __getstate__(self):
+        # Workers always use the module tokenizer; avoid shipping it with every shard.
+        state = dict(self.__dict__)
+        state.pop("tokenizer", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tokenizer = TOKENIZER
+
+
+def analyze_texts(texts: list[str], sketch_width: int | None = None) -> MixedCounters:
+    """Count one shard of texts; runs inside pool workers."""
+    return MixedCounters(sketch_width=sketch_width).add_texts(texts)
+
+
+SKETCH_WIDTH = _env_int("MIXED_SKETCH_WIDTH", 4096)
+MAX_SKETCH_WIDTH = 1 << 20
+
+
+def sketch_width_for(width: int | None = None, epsilon: float | None = None) -> int:
+    """Resolve the summary size from an explicit width or a relative error bound."""
+    if width:
+        return max(1, min(int(width), MAX_SKETCH_WIDTH))
+    if epsilon and epsilon > 0:
+        return max(1, min(math.ceil(1 / epsilon), MAX_SKETCH_WIDTH))
+    return SKETCH_WIDTH
+
+
+# Batches at or above this many items are sharded across the process pool.
+PARALLEL_MIN_ITEMS = _env_int("MIXED_PARALLEL_MIN_ITEMS", 2000)
+SHARD_SIZE = _env_int("MIXED_SHARD_SIZE", 2000)
+POOL_WORKERS = _env_int("MIXED_POOL_WORKERS", os.cpu_count() or 1)
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the server process already runs an event loop and threadpool.
+        _pool = ProcessPoolExecutor(max_workers=max(1, POOL_WORKERS), mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    global _pool
+    if _pool is pool:
+        logging.warning("analysis process pool broken; starting a fresh one")
+        _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _executor() -> Executor | None:
+    if POOL_WORKERS <= 1:
+        return None
+    try:
+        return get_pool()
+    except Exception:
+        return None
+
+
+async def _count(texts: list[str], sketch_width: int | None, parallel: bool) -> MixedCounters:
+    """Count one shard on the process pool if ``parallel``, else on the default threadpool.
+
+    A pool that lost a worker (e.g. to the OOM killer) stays broken, so it is
+    discarded and the shard retried once on a fresh pool before falling back
+    to the threadpool.
+    """
+    loop = asyncio.get_running_loop()
+    for _ in range(2 if parallel else 0):
+        pool = _executor()
+        if pool is None:
+            break
+        try:
+            return await loop.run_in_executor(pool, analyze_texts, texts, sketch_width)
+        except BrokenProcessPool:
+            _discard_pool(pool)
+    return await loop.run_in_executor(None, analyze_texts, texts, sketch_width)
+
+
+async def analyze_texts_async(texts: list[str], shard_size: int = SHARD_SIZE, sketch_width: int | None = None) -> MixedCounters:
+    """Count texts off the event loop, sharding large batches across processes."""
+    if len(texts) < PARALLEL_MIN_ITEMS or _executor() is None:
+        return await _count(texts, sketch_width, parallel=False)
+    shard_size = max(1, shard_size)
+    shards = [texts[i:i+shard_size] for i in range(0, len(texts), shard_size)]
+    parts = await asyncio.gather(*(_count(sh, sketch_width, parallel=True) for sh in shards))
+    total = MixedCounters(sketch_width=sketch_width)
+    for part in parts:
+        total.merge(part)
+    return total
+
+
+def _ndjson_text(line: bytes, lineno: int) -> str:
+    try:
+        obj = json.loads(line)
+    except ValueError as e:
+        raise ValueError(f"line {lineno}: {e}")
+    text = obj.get("text") if isinstance(obj, dict) else None
+    if not isinstance(text, str):
+        raise ValueError(f"line {lineno}: expected an object with a string 'text'")
+    return text
+
+
+async def analyze_ndjson(chunks: AsyncIterable[bytes], shard_size: int = SHARD_SIZE, sketch_width: int | None = None) -> MixedCounters:
+    """Count newline-delimited ContentItem objects as they arrive.
+
+    At most one shard is buffered while up to POOL_WORKERS shards are being
+    counted, so memory is bounded by shard size and vocabulary rather than
+    by the size of the upload. Shards are merged in arrival order. The
+    process pool is only used once a full shard has arrived; smaller
+    uploads are counted on the threadpool.
+    """
+    parallel = False
+    max_pending = max(1, POOL_WORKERS)
+    shard_size = max(1, shard_size)
+    total = MixedCounters(sketch_width=sketch_width)
+    pending: deque = deque()
+    batch: list[str] = []
+    buf = b""
+    lineno = 0
+
+    async def submit(texts: list[str]) -> None:
+        nonlocal parallel
+        parallel = parallel or len(texts) >= shard_size
+        pending.append(asyncio.ensure_future(_count(texts, sketch_width, parallel)))
+        if len(pending) >= max_pending:
+            total.merge(await pending.popleft())
+
+    try:
+        async for chunk in chunks:
+            buf += chunk
+            if b"\n" not in chunk:
+                continue
+            lines = buf.split(b"\n")
+            buf = lines.pop()
+            for line in lines:
+                lineno += 1
+                if line.strip():
+                    batch.append(_ndjson_text(line, lineno))
+                    if len(batch) >= shard_size:
+                        await submit(batch)
+                        batch = []
+        if buf.strip():
+            batch.append(_ndjson_text(buf, lineno + 1))
+        if batch:
+            await submit(batch)
+        while pending:
+            total.merge(await pending.popleft())
+    finally:
+        for fut in pending:
+            fut.cancel()
+    return total
@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+try:
+    from pymongo import UpdateOne
+    from pymongo.errors import OperationFailure
+except Exception:
+    UpdateOne = None
+    OperationFailure = Exception
+
+from server import metrics as prom
+
+
+EVENTS = "analytics_events"
+ROLLUPS = "analytics_rollups"
+GRANULARITIES = ("minute", "hour", "day")
+
+ANALYTICS_QUEUE_DEPTH = prom.gauge("analytics_queue_depth", "Analytics events waiting to be written")
+ANALYTICS_EVENTS_WRITTEN = prom.counter("analytics_events_written_total", "Analytics events written to Mongo")
+ANALYTICS_EVENTS_DROPPED = prom.counter("analytics_events_dropped_total", "Analytics events discarded before reaching Mongo", ["reason"])
+ANALYTICS_ROLLUP_ERRORS = prom.counter("analytics_rollup_errors_total", "Analytics batches whose rollup update failed")
+ANALYTICS_FLUSH_SECONDS = prom.histogram(
+    "analytics_flush_seconds", "Latency of analytics insert_many flushes", ["outcome"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+def bucket_start(ts: datetime, granularity: str) -> datetime:
+    if granularity == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+async def ensure_indexes(db, retention_days: float) -> None:
+    """Index rollups and expire raw events (and fine-grained rollups) after their retention."""
+    await db[ROLLUPS].create_index([("tenant_id", 1), ("granularity", 1), ("bucket", 1), ("name", 1)], unique=True)
+    await db[ROLLUPS].create_index("expires_at", expireAfterSeconds=0)
+    if retention_days > 0:
+        seconds = int(retention_days * 86400)
+        try:
+            await db[EVENTS].create_index("created_at", expireAfterSeconds=seconds)
+        except OperationFailure:
+            # The TTL index exists with another retention; change it in place.
+            await db.command("collMod", EVENTS, index={"keyPattern": {"created_at": 1}, "expireAfterSeconds": seconds})
+
+
+def rollup_ops(docs: list[dict], rollup_days: dict[str, float]) -> list:
+    """``$inc`` upserts for the per-minute/hour/day counters touched by ``docs``."""
+    counts: Counter = Counter()
+    for doc in docs:
+        ts = doc.get("created_at")
+        if not isinstance(ts, datetime):
+            continue
+        for g in GRANULARITIES:
+            counts[(doc.get("tenant_id"), g, bucket_start(ts, g), doc.get("name"))] += 1
+    ops = []
+    for (tenant, g, bucket, name), n in counts.items():
+        update: dict = {"$inc": {"count": n}}
+        days = rollup_days.get(g) or 0
+        if days > 0:
+            update["$setOnInsert"] = {"expires_at": bucket + timedelta(days=days)}
+        ops.append(UpdateOne({"tenant_id": tenant, "granularity": g, "bucket": bucket, "name": name}, update, upsert=True))
+    return ops
+
+
+async def query_rollups(db, tenant: str, granularity: str, start: datetime, end: datetime, name: str | None = None, limit: int = 10000) -> list[dict]:
+    flt: dict = {"tenant_id": tenant, "granularity": granularity, "bucket": {"$gte": bucket_start(start, granularity), "$lt": end}}
+    if name:
+        flt["name"] = name
+    cursor = db[ROLLUPS].find(flt, projection={"_id": 0, "bucket": 1, "name": 1, "count": 1}, sort=[("bucket", 1), ("name", 1)], limit=limit)
+    return await cursor.to_list(length=limit)
+
+
+def _only_duplicates(e: Exception) -> bool:
+    errors = (getattr(e, "details", None) or {}).get("writeErrors") or []
+    return bool(errors) and all(w.get("code") == 11000 for w in errors)
+
+
+class EventBuffer:
+    """Queues analytics events in memory and writes them with ``insert_many``.
+
+    ``submit`` never waits on Mongo: events go into a bounded queue and a
+    single consumer task writes them in batches of up to ``batch_size``,
+    or whatever has arrived once ``flush_interval`` seconds have passed
+    since the first event of the batch. When the queue is full new events
+    are dropped and counted rather than slowing callers down. A failed
+    write is retried ``retries`` times before the batch is dropped.
+    Each stored batch also bumps the per-minute/hour/day counters in
+    ``analytics_rollups``. ``stop`` drains what is queued before returning.
+    """
+
+    def __init__(self, max_queue: int = 50000, batch_size: int = 500, flush_interval: float = 1.0, retries: int = 3, rollup_days: dict[str, float] | None = None) -> None:
+        self.rollup_days = rollup_days or {}
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.db = None
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        # Events taken off the queue but not yet handed to Mongo, and the write in progress.
+        self._batch: list[dict] = []
+        self._writing: asyncio.Future | None = None
+
+    def submit(self, db, docs: list[dict]) -> int:
+        """Queue ``docs`` for ``db``; returns how many were accepted."""
+        self.db = db
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        accepted = 0
+        for doc in docs:
+            try:
+                self._queue.put_nowait(doc)
+                accepted += 1
+            except asyncio.QueueFull:
+                break
+        if accepted < len(docs):
+            prom.inc(ANALYTICS_EVENTS_DROPPED, len(docs) - accepted, reason="queue_full")
+        prom.set_value(ANALYTICS_QUEUE_DEPTH, self._queue.qsize())
+        return accepted
+
+    def _take(self, batch: list[dict]) -> None:
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return
+
+    async def _collect(self) -> list[dict]:
+        batch = self._batch
+        batch.append(await self._queue.get())
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            self._take(batch)
+            remaining = deadline - time.monotonic()
+            if len(batch) >= self.batch_size or remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write(self, batch: list[dict]) -> None:
+        delay = 0.5
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                await self.db[EVENTS].insert_many(batch, ordered=False)
+            except Exception as e:
+                if attempt and _only_duplicates(e):
+                    # A retry after a partial insert: everything is stored already.
+                    prom.inc(ANALYTICS_EVENTS_WRITTEN, len(batch))
+                    await self._rollup(batch)
+                    return
+                prom.observe(ANALYTICS_FLUSH_SECONDS, time.perf_counter() - start, outcome="error")
+                if attempt == self.retries:
+                    logging.warning(f"analytics flush dropped {len(batch)} events: {e}")
+                    prom.inc(ANALYTICS_EVENTS_DROPPED, len(batch), reason="db_error")
+                    return
+                await asyncio.sleep(delay)
+                delay *= 2
+                continue
+            prom.observe(ANALYTICS_FLUSH_SECONDS, time.perf_counter() - start, outcome="ok")
+            prom.inc(ANALYTICS_EVENTS_WRITTEN, len(batch))
+            await self._rollup(batch)
+            return
+
+    async def _rollup(self, batch: list[dict]) -> None:
+        # Counters are bumped only after the raw events are stored, once per batch.
+        if UpdateOne is None:
+            return
+        ops = rollup_ops(batch, self.rollup_days)
+        if not ops:
+            return
+        try:
+            await self.db[ROLLUPS].bulk_write(ops, ordered=False)
+        except Exception as e:
+            logging.warning(f"analytics rollup update failed for {len(batch)} events: {e}")
+            prom.inc(ANALYTICS_ROLLUP_ERRORS)
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            self._batch = []
+            prom.set_value(ANALYTICS_QUEUE_DEPTH, self._queue.qsize())
+            # Shielded so that stopping the consumer never abandons a batch mid-write.
+            self._writing = asyncio.ensure_future(self._write(batch))
+            await asyncio.shield(self._writing)
+
+    async def flush(self) -> None:
+        """Write everything currently queued (used on shutdown)."""
+        if self._queue is None or self.db is None:
+            return
+        if self._writing is not None:
+            await self._writing
+        batch, self._batch = self._batch, []
+        while batch or not self._queue.empty():
+            self._take(batch)
+            await self._write(batch)
+            batch = []
+        prom.set_value(ANALYTICS_QUEUE_DEPTH, 0)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            left = (self._queue.qsize() if self._queue is not None else 0) + len(self._batch)
+            logging.warning(f"analytics drain timed out with {left} events queued")
+            prom.inc(ANALYTICS_EVENTS_DROPPED, left, reason="shutdown")
@@ -1,8 +1,21 @@
+import asyncio
+import hashlib
+import logging
 import os
+import re
+import time
 from typing import Any, Dict
 
 from fastapi import HTTPException, status
 import jwt
+try:
+    from google.auth import jwt as google_jwt
+except Exception:
+    google_jwt = None
+
+from server import metrics as prom
+from server.cache import TTLCache
+from server.http_client import http_client
 
 
 def _env(name: str, default: str | None = None) -> str | None:
@@ -14,14 +27,41 @@ def _env(name: str, default: str | None = None) -> str | None:
         return default
     return s or default
 
-def _get_supabase_jwt_secret() -> str:
-    secret = _env("SUPABASE_JWT_SECRET")
-    if not secret:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Server missing SUPABASE_JWT_SECRET",
-        )
-    return secret
+# Decoded claims keyed by token digest; entries never outlive the token's exp.
+JWT_CACHE_TTL = float(_env("JWT_CACHE_TTL", "300"))
+_claims_cache = TTLCache(max_entries=int(_env("JWT_CACHE_MAX_ENTRIES", "10000")), ttl=JWT_CACHE_TTL)
+
+# The secret is resolved once and re-checked at most every SECRET_RECHECK seconds
+# (or immediately on a signature failure) so a rotation drops stale claims.
+SECRET_RECHECK = float(_env("SUPABASE_JWT_SECRET_RECHECK", "60"))
+_secret: str | None = None
+_secret_checked_at = 0.0
+
+
+def _get_supabase_jwt_secret(refresh: bool = False) -> str:
+    global _secret, _secret_checked_at
+    now = time.monotonic()
+    if _secret is None or refresh or now - _secret_checked_at >= SECRET_RECHECK:
+        secret = _env("SUPABASE_JWT_SECRET")
+        if not secret:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Server missing SUPABASE_JWT_SECRET",
+            )
+        if _secret is not None and secret != _secret:
+            _claims_cache.clear()
+        _secret = secret
+        _secret_checked_at = now
+    return _secret
+
+
+def _decode(token: str, secret: str) -> Dict[str, Any]:
+    return jwt.decode(
+        token,
+        secret,
+        algorithms=["HS256"],
+        options={"verify_aud": False},
+    )
 
 
 def verify_supabase_jwt(token: str) -> Dict[str, Any]:
@@ -29,17 +69,139 @@ def verify_supabase_jwt(token: str) -> Dict[str, Any]:
 
     The token is validated using SUPABASE_JWT_SECRET. Audience verification is
     disabled because Supabase does not set a fixed audience for all flows.
+    Verified claims are cached until the earlier of JWT_CACHE_TTL and exp.
     """
     secret = _get_supabase_jwt_secret()
+    key = hashlib.sha256(token.encode("utf-8")).digest()
+    cached = _claims_cache.get(key)
+    if cached is not None:
+        return dict(cached)
     try:
-        payload = jwt.decode(
-            token,
-            secret,
-            algorithms=["HS256"],
-            options={"verify_aud": False},
-        )
-        return payload
+        try:
+            payload = _decode(token, secret)
+        except jwt.InvalidSignatureError:
+            fresh = _get_supabase_jwt_secret(refresh=True)
+            if fresh == secret:
+                raise
+            payload = _decode(token, fresh)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired")
     except jwt.InvalidTokenError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
\ No newline at end of file
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    ttl = JWT_CACHE_TTL
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        ttl = min(ttl, exp - time.time())
+    _claims_cache.set(key, payload, ttl=ttl)
+    return dict(payload)
+
+
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+GOOGLE_CERTS_REFRESH_SECONDS = prom.histogram("google_certs_refresh_seconds", "Latency of Google signing certificate fetches", ["outcome"])
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class GoogleCertCache:
+    """Google's ID-token signing certificates, kept warm in memory.
+
+    Certificates are held for the Cache-Control max-age of the response and
+    refreshed by a background task shortly before they expire, so login
+    verification never waits on a network round trip. Concurrent refreshes
+    share one request; if a refresh fails the previous certificates stay in use.
+    """
+
+    def __init__(self, url: str = GOOGLE_CERTS_URL, refresh_ahead: float = 300.0, min_forced_interval: float = 30.0) -> None:
+        self.url = url
+        self.refresh_ahead = refresh_ahead
+        self.min_forced_interval = min_forced_interval
+        self.certs: dict[str, str] = {}
+        self.expires_at = 0.0
+        self.refresh_at = 0.0
+        self.fetched_at = 0.0
+        self._inflight: asyncio.Future | None = None
+        self._task: asyncio.Task | None = None
+
+    async def _fetch(self) -> tuple[dict, int | None]:
+        r = await http_client("google").get(self.url)
+        r.raise_for_status()
+        m = _MAX_AGE_RE.search(r.headers.get("Cache-Control") or "")
+        return r.json(), int(m.group(1)) if m else None
+
+    async def _refresh(self) -> dict:
+        start = time.perf_counter()
+        try:
+            certs, max_age = await self._fetch()
+        except Exception:
+            prom.observe(GOOGLE_CERTS_REFRESH_SECONDS, time.perf_counter() - start, outcome="error")
+            raise
+        prom.observe(GOOGLE_CERTS_REFRESH_SECONDS, time.perf_counter() - start, outcome="ok")
+        now = time.monotonic()
+        lifetime = max(60, max_age or 3600)
+        self.certs = certs
+        self.fetched_at = now
+        self.expires_at = now + lifetime
+        self.refresh_at = now + max(lifetime / 2, lifetime - self.refresh_ahead)
+        return certs
+
+    async def refresh(self) -> dict:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.ensure_future(self._refresh())
+        return await asyncio.shield(self._inflight)
+
+    async def get(self) -> dict:
+        if self.certs and time.monotonic() < self.expires_at:
+            return self.certs
+        try:
+            return await self.refresh()
+        except Exception:
+            if self.certs:
+                return self.certs
+            raise
+
+    async def get_for_kid(self, kid: str | None) -> dict:
+        """Certificates containing ``kid``, refetching early if Google rotated keys."""
+        certs = await self.get()
+        if kid and kid not in certs and time.monotonic() - self.fetched_at >= self.min_forced_interval:
+            certs = await self.refresh()
+        return certs
+
+    async def _run(self) -> None:
+        backoff = 5.0
+        while True:
+            await asyncio.sleep(max(0.0, self.refresh_at - time.monotonic()))
+            try:
+                await self.refresh()
+                backoff = 5.0
+            except Exception as e:
+                logging.warning(f"google certs refresh failed: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 300.0)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+GOOGLE_CERTS = GoogleCertCache()
+
+
+async def verify_google_id_token(token: str, audience: str) -> Dict[str, Any]:
+    """Verify a Google ID token against the cached signing certificates.
+
+    Equivalent to google.oauth2.id_token.verify_oauth2_token; raises ValueError
+    on any verification failure.
+    """
+    if google_jwt is None:
+        raise ValueError("google-auth unavailable")
+    kid = google_jwt.decode_header(token).get("kid")
+    certs = await GOOGLE_CERTS.get_for_kid(kid)
+    claims = google_jwt.decode(token, certs=certs, audience=audience)
+    if claims.get("iss") not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer. 'iss' should be one of {GOOGLE_ISSUERS} but is {claims.get('iss')}")
+    return claims
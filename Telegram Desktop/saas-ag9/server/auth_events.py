@@ -0,0 +1,117 @@
+import base64
+import calendar
+import logging
+from datetime import datetime, timedelta
+
+try:
+    from bson import ObjectId
+except Exception:
+    ObjectId = None
+
+try:
+    from pymongo.errors import OperationFailure
+except Exception:
+    OperationFailure = Exception
+
+
+COLLECTION = "auth_events"
+EPOCH = datetime(1970, 1, 1)
+
+
+async def ensure_collection(db, retention_days: float) -> str:
+    """Create ``auth_events`` as a time-series collection that expires old events.
+
+    Returns the storage kind in use. Servers without time-series support get
+    a regular collection with a TTL index instead. An existing regular
+    collection is kept (it cannot be converted in place) and indexed.
+    """
+    expire = int(retention_days * 86400) if retention_days > 0 else None
+    cursor = await db.list_collections(filter={"name": COLLECTION})
+    info = await cursor.to_list(length=1)
+    if not info:
+        opts = {"timeseries": {"timeField": "ts", "metaField": "meta", "granularity": "seconds"}}
+        if expire:
+            opts["expireAfterSeconds"] = expire
+        try:
+            await db.create_collection(COLLECTION, **opts)
+            await db[COLLECTION].create_index([("meta.event", 1), ("ts", -1)])
+            return "timeseries"
+        except OperationFailure as e:
+            logging.warning(f"auth_events time-series collection unavailable, using a regular one: {e}")
+    elif "timeseries" in (info[0].get("options") or {}):
+        await db.command("collMod", COLLECTION, expireAfterSeconds=expire if expire else "off")
+        return "timeseries"
+    else:
+        logging.warning("auth_events is a regular collection; drop or rename it to switch to time-series storage")
+        try:
+            await backfill(db)
+        except OperationFailure as e:
+            logging.warning(f"auth_events legacy backfill failed: {e}")
+    await db[COLLECTION].create_index([("ts", -1), ("_id", -1)])
+    await db[COLLECTION].create_index([("meta.event", 1), ("ts", -1), ("_id", -1)])
+    if expire:
+        try:
+            await db[COLLECTION].create_index("ts", expireAfterSeconds=expire)
+        except OperationFailure:
+            await db.command("collMod", COLLECTION, index={"keyPattern": {"ts": 1}, "expireAfterSeconds": expire})
+    return "collection"
+
+
+async def backfill(db) -> int:
+    """Give rows stored before time-series storage a ``ts`` (their insert time) and ``meta``."""
+    res = await db[COLLECTION].update_many(
+        {"ts": {"$exists": False}},
+        [{"$set": {"ts": {"$toDate": "$_id"}, "meta": {"event": "$event", "source": "$source"}}}],
+    )
+    if res.modified_count:
+        logging.info(f"auth_events backfilled ts/meta on {res.modified_count} legacy rows")
+    return res.modified_count
+
+
+def _epoch_ms(ts: datetime) -> int:
+    # Mongo hands back naive UTC datetimes; ``timestamp()`` would read them as local time.
+    return calendar.timegm(ts.utctimetuple()) * 1000 + ts.microsecond // 1000
+
+
+def encode_cursor(doc: dict) -> str:
+    """Cursor for resuming after ``doc``; rows without ``ts`` fall back to their ObjectId time."""
+    ts = doc.get("ts") or getattr(doc["_id"], "generation_time", None) or EPOCH
+    raw = f"{_epoch_ms(ts)}:{doc['_id']}"
+    return base64.urlsafe_b64encode(raw.encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, object]:
+    """Raises ValueError for anything ``encode_cursor`` could not have produced."""
+    raw = base64.b64decode(cursor + "=" * (-len(cursor) % 4), altchars=b"-_", validate=True).decode("ascii")
+    ms, _, oid = raw.partition(":")
+    ts = EPOCH + timedelta(milliseconds=int(ms))
+    return ts, ObjectId(oid) if ObjectId is not None else oid
+
+
+def page_filter(event: str | None, start: datetime | None, end: datetime | None, cursor: str | None) -> dict:
+    """Filter for one page, newest first, resuming after ``cursor`` on ``(ts, _id)``."""
+    clauses: list[dict] = []
+    if event:
+        clauses.append({"meta.event": event})
+    ts_range: dict = {}
+    if start:
+        ts_range["$gte"] = start
+    if end:
+        ts_range["$lt"] = end
+    if ts_range:
+        clauses.append({"ts": ts_range})
+    if cursor:
+        ts, oid = decode_cursor(cursor)
+        clauses.append({"$or": [{"ts": {"$lt": ts}}, {"ts": ts, "_id": {"$lt": oid}}]})
+    return {"$and": clauses} if len(clauses) > 1 else (clauses[0] if clauses else {})
+
+
+def to_item(doc: dict) -> dict:
+    meta = doc.get("meta") or {}
+    return {
+        "_id": str(doc["_id"]),
+        "event": meta.get("event", doc.get("event")),
+        "metadata": doc.get("metadata") or {},
+        "time": doc.get("time"),
+        "source": meta.get("source", doc.get("source")),
+    }
@@ -0,0 +1,318 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+try:
+    from pymongo import UpdateOne
+    from pymongo.errors import DuplicateKeyError
+except Exception:
+    UpdateOne = None
+    DuplicateKeyError = Exception
+
+from server import metrics as prom
+from server import shopify
+from server.http_client import http_client
+
+
+PRODUCTS = "shopify_products"
+VARIANTS = "shopify_variants"
+JOBS = "shopify_sync_jobs"
+WRITE_BATCH = 1000
+# A running job whose progress has not moved for this long is treated as dead.
+STALE_AFTER = timedelta(minutes=10)
+# Incremental syncs look back a little past the previous start to cover clock skew.
+OVERLAP = timedelta(minutes=5)
+# Incremental exports never include products or variants deleted upstream, so
+# a sync runs as a full one (which prunes them) once the last full sync is this old.
+FULL_EVERY = timedelta(hours=24)
+FINISHED = ("completed", "failed", "cancelled")
+
+BULK_FIELDS = """
+        id
+        title
+        handle
+        vendor
+        productType
+        tags
+        status
+        totalInventory
+        createdAt
+        updatedAt
+        variants {
+          edges {
+            node {
+              id
+              title
+              sku
+              barcode
+              price
+              inventoryQuantity
+              updatedAt
+            }
+          }
+        }
+"""
+
+RUN_MUTATION = """
+mutation RunBulk($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+STATUS_QUERY = """
+query BulkStatus($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation { id status errorCode objectCount fileSize url partialDataUrl }
+  }
+}
+"""
+
+SYNC_LINES_TOTAL = prom.counter("shopify_sync_lines_total", "JSONL lines applied by catalog syncs", ["kind"])
+SYNC_DURATION_SECONDS = prom.histogram(
+    "shopify_sync_duration_seconds", "Duration of catalog sync jobs", ["mode", "outcome"],
+    buckets=(10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200),
+)
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat(timespec="seconds") + "Z"
+
+
+def bulk_query(since: str | None) -> str:
+    search = f'(query: "updated_at:>\'{since}\'")' if since else ""
+    return "{ products" + search + " { edges { node {" + BULK_FIELDS + "} } } }"
+
+
+async def ensure_indexes(db) -> None:
+    await db[VARIANTS].create_index("product_id")
+    await db[PRODUCTS].create_index("updatedAt")
+    # The full-sync prune deletes by synced_at; without these it scans both collections.
+    await db[PRODUCTS].create_index("synced_at")
+    await db[VARIANTS].create_index("synced_at")
+    await db[JOBS].create_index([("started_at", -1)])
+    # At most one job holds the claim, so concurrent starts cannot both launch a bulk operation.
+    await db[JOBS].create_index("active", unique=True, partialFilterExpression={"active": True})
+
+
+def _product_doc(row: dict, synced_at: str) -> dict:
+    doc = {k: v for k, v in row.items() if k != "id"}
+    doc["synced_at"] = synced_at
+    return doc
+
+
+def _variant_doc(row: dict, synced_at: str) -> dict:
+    doc = {k: v for k, v in row.items() if k not in ("id", "__parentId")}
+    doc["product_id"] = row["__parentId"]
+    doc["synced_at"] = synced_at
+    return doc
+
+
+class SyncInProgress(RuntimeError):
+    def __init__(self, job_id: str | None) -> None:
+        super().__init__(f"sync in progress: {job_id}")
+        self.job_id = job_id
+
+
+class CatalogSync:
+    """Mirrors the Shopify catalog into ``shopify_products``/``shopify_variants``.
+
+    A job starts a bulk operation, polls it until Shopify has written the
+    JSONL export, then streams the file line by line and upserts it in
+    batches of ``batch_size`` with ``bulk_write``; the next batch is parsed
+    while the previous one is being written. Incremental jobs only export
+    products updated since the last completed job started. Progress and
+    throughput are kept on the job document in ``shopify_sync_jobs``.
+    Shopify runs one bulk query per shop at a time, so only one job may be
+    active: a job is inserted with ``active: true`` under a unique partial
+    index and gives the claim up when it finishes or goes stale. Once the
+    last full sync is older than ``full_every`` the next job runs in full.
+    """
+
+    def __init__(self, batch_size: int = WRITE_BATCH, poll_interval: float = 2.0, max_poll_interval: float = 15.0, full_every: timedelta = FULL_EVERY) -> None:
+        self.batch_size = batch_size
+        self.full_every = full_every
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._tasks: set[asyncio.Task] = set()
+
+    async def _release_stale(self, db) -> None:
+        cutoff = (datetime.utcnow() - STALE_AFTER).isoformat(timespec="seconds") + "Z"
+        await db[JOBS].update_many(
+            {"active": True, "updated_at": {"$lt": cutoff}},
+            {"$set": {"status": "failed", "error": "stale", "finished_at": _now()}, "$unset": {"active": ""}},
+        )
+
+    async def latest_job(self, db) -> dict | None:
+        return await db[JOBS].find_one({}, sort=[("started_at", -1)])
+
+    async def _since(self, db) -> str | None:
+        """Start of the incremental window, or None when the job should run in full."""
+        full = await db[JOBS].find_one({"status": "completed", "mode": "full"}, sort=[("started_at", -1)])
+        if not full or datetime.fromisoformat(full["started_at"].rstrip("Z")) < datetime.utcnow() - self.full_every:
+            return None
+        last = await db[JOBS].find_one({"status": "completed"}, sort=[("started_at", -1)])
+        started = datetime.fromisoformat(last["started_at"].rstrip("Z")) - OVERLAP
+        return started.isoformat(timespec="seconds") + "Z"
+
+    async def start(self, db, full: bool = False) -> dict:
+        """Claim the sync, record a new job and run it in the background; returns the job document.
+
+        Raises ``SyncInProgress`` if another job holds the claim.
+        """
+        if UpdateOne is None:
+            raise RuntimeError("pymongo unavailable")
+        await self._release_stale(db)
+        since = None if full else await self._since(db)
+        now = _now()
+        job = {
+            "_id": uuid4().hex,
+            "mode": "incremental" if since else "full",
+            "since": since,
+            "status": "queued",
+            "started_at": now,
+            "updated_at": now,
+            "lines": 0,
+            "products": 0,
+            "variants": 0,
+            "bytes": 0,
+            "active": True,
+        }
+        try:
+            await db[JOBS].insert_one(job)
+        except DuplicateKeyError:
+            active = await db[JOBS].find_one({"active": True}, {"_id": 1})
+            raise SyncInProgress(active and active["_id"])
+        task = asyncio.create_task(self._run(db, job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _update(self, db, job: dict, **fields) -> None:
+        job.update(fields, updated_at=_now())
+        update = {"$set": {k: job[k] for k in list(fields) + ["updated_at"]}}
+        if fields.get("status") in FINISHED:
+            job.pop("active", None)
+            update["$unset"] = {"active": ""}
+        await db[JOBS].update_one({"_id": job["_id"]}, update)
+
+    async def _run(self, db, job: dict) -> None:
+        start = time.perf_counter()
+        outcome = "failed"
+        try:
+            await self._update(db, job, status="running")
+            op = await self._start_bulk(bulk_query(job["since"]))
+            await self._update(db, job, bulk_operation_id=op["id"])
+            op = await self._wait(db, job, op["id"])
+            url = op.get("url")
+            synced_at = _now()
+            if url:
+                await self._update(db, job, status="downloading", object_count=int(op.get("objectCount") or 0))
+                await self._apply(db, job, url, start, synced_at)
+            if job["mode"] == "full":
+                # Anything a full export did not touch no longer exists in Shopify.
+                pruned = (await db[PRODUCTS].delete_many({"synced_at": {"$lt": synced_at}})).deleted_count
+                await db[VARIANTS].delete_many({"synced_at": {"$lt": synced_at}})
+                await self._update(db, job, pruned=pruned)
+            outcome = "completed"
+            await self._update(db, job, status="completed", finished_at=_now(), seconds=round(time.perf_counter() - start, 1))
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            await asyncio.shield(self._update(db, job, status="cancelled", finished_at=_now()))
+            raise
+        except Exception as e:
+            logging.warning(f"shopify catalog sync {job['_id']} failed: {e}")
+            detail = getattr(e, "detail", None) or str(e)
+            await self._update(db, job, status="failed", error=str(detail)[:500], finished_at=_now())
+        finally:
+            prom.observe(SYNC_DURATION_SECONDS, time.perf_counter() - start, mode=job["mode"], outcome=outcome)
+
+    async def _start_bulk(self, query: str) -> dict:
+        body = await shopify.graphql(RUN_MUTATION, {"query": query}, operation="bulk_run", cost=10, lane="background")
+        result = (body.get("data") or {}).get("bulkOperationRunQuery") or {}
+        errors = result.get("userErrors") or body.get("errors")
+        if errors or not result.get("bulkOperation"):
+            raise RuntimeError(f"bulk operation rejected: {errors}")
+        return result["bulkOperation"]
+
+    async def _wait(self, db, job: dict, op_id: str) -> dict:
+        delay = self.poll_interval
+        while True:
+            await asyncio.sleep(delay)
+            body = await shopify.graphql(STATUS_QUERY, {"id": op_id}, operation="bulk_status", cost=1, lane="background")
+            op = (body.get("data") or {}).get("node") or {}
+            status = op.get("status")
+            if status == "COMPLETED":
+                return op
+            if status in ("FAILED", "CANCELED", "EXPIRED"):
+                raise RuntimeError(f"bulk operation {status.lower()}: {op.get('errorCode')}")
+            await self._update(db, job, bulk_status=status, object_count=int(op.get("objectCount") or 0))
+            delay = min(delay * 1.5, self.max_poll_interval)
+
+    async def _apply(self, db, job: dict, url: str, start: float, synced_at: str) -> None:
+        products: list = []
+        variants: list = []
+        pending: asyncio.Task | None = None
+        counts = {"lines": 0, "products": 0, "variants": 0, "bytes": 0}
+
+        async def write(p: list, v: list) -> None:
+            if p:
+                await db[PRODUCTS].bulk_write(p, ordered=False)
+            if v:
+                await db[VARIANTS].bulk_write(v, ordered=False)
+            prom.inc(SYNC_LINES_TOTAL, len(p), kind="product")
+            prom.inc(SYNC_LINES_TOTAL, len(v), kind="variant")
+            elapsed = max(time.perf_counter() - start, 1e-6)
+            await self._update(db, job, **counts, lines_per_second=round(counts["lines"] / elapsed, 1))
+
+        async def flush() -> None:
+            nonlocal pending, products, variants
+            if pending is not None:
+                await pending
+            pending = asyncio.create_task(write(products, variants))
+            products, variants = [], []
+
+        try:
+            async with http_client("shopify_bulk").stream("GET", url) as r:
+                r.raise_for_status()
+                async for line in r.aiter_lines():
+                    if not line:
+                        continue
+                    counts["bytes"] += len(line) + 1
+                    row = json.loads(line)
+                    gid = row.get("id")
+                    if not gid:
+                        continue
+                    counts["lines"] += 1
+                    if "__parentId" in row:
+                        variants.append(UpdateOne({"_id": gid}, {"$set": _variant_doc(row, synced_at)}, upsert=True))
+                        counts["variants"] += 1
+                    else:
+                        products.append(UpdateOne({"_id": gid}, {"$set": _product_doc(row, synced_at)}, upsert=True))
+                        counts["products"] += 1
+                    if len(products) + len(variants) >= self.batch_size:
+                        await flush()
+            await flush()
+            await pending
+        finally:
+            if pending is not None and not pending.done():
+                pending.cancel()
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def delete_product(db, gid: str) -> None:
+    await db[PRODUCTS].delete_one({"_id": gid})
+    await db[VARIANTS].delete_many({"product_id": gid})
+
+
+CATALOG_SYNC = CatalogSync()
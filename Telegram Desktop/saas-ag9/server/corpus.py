@@ -0,0 +1,157 @@
+import asyncio
+from collections import Counter
+from datetime import datetime
+
+try:
+    from pymongo import ReturnDocument, UpdateOne
+    from pymongo.errors import BulkWriteError, DuplicateKeyError
+except Exception:
+    ReturnDocument = UpdateOne = None
+    BulkWriteError = DuplicateKeyError = Exception
+
+from server.analysis import MixedCounters
+
+
+TERMS = "corpus_terms"
+STATS = "corpus_stats"
+# Stored counter kind -> MixedCounters attribute.
+KINDS = {"en_terms": "en_terms", "th_terms": "th_terms", "en_phrases": "en_phr", "th_phrases": "th_phr"}
+WRITE_BATCH = 1000
+# Recent batch ids remembered on each term and on the stats document. A
+# retried batch is skipped wherever its id is still among them.
+BATCH_MEMORY = 16
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat(timespec="seconds") + "Z"
+
+
+class StoredTop(Counter):
+    """Top slice of a stored counter that still reports the full stored total."""
+
+    def __init__(self, rows: list[dict], stored_total: int) -> None:
+        super().__init__()
+        for r in rows:
+            self[r["term"]] = r["count"]
+        self.stored_total = stored_total
+
+    def total(self) -> int:
+        return self.stored_total
+
+
+async def ensure_indexes(db) -> None:
+    await db[TERMS].create_index([("tenant_id", 1), ("kind", 1), ("term", 1)], unique=True)
+    await db[TERMS].create_index([("tenant_id", 1), ("kind", 1), ("count", -1)])
+
+
+def _marked(flt: dict, batch_id: str) -> dict:
+    return {**flt, "batches": {"$ne": batch_id}}
+
+
+def _remember(batch_id: str) -> dict:
+    return {"batches": {"$each": [batch_id], "$slice": -BATCH_MEMORY}}
+
+
+async def _write(coll, ops: list) -> tuple[int, list]:
+    """``bulk_write`` returning ``(upserted, duplicate-key ops)``; other write errors raise.
+
+    With the batch id in the filter, an upsert only hits a duplicate key
+    when the term already carries this batch (applied before) or another
+    writer inserted the term at the same moment.
+    """
+    try:
+        res = await coll.bulk_write(ops, ordered=False)
+        return res.upserted_count, []
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(w.get("code") != 11000 for w in errors):
+            raise
+        return e.details.get("nUpserted", 0), [ops[w["index"]] for w in errors]
+
+
+async def fold(db, tenant: str, stats: MixedCounters, items: int, batch_id: str) -> int:
+    """Add a batch's counters to the tenant aggregate, at most once per ``batch_id``.
+
+    Every term and the stats document remember the last ``BATCH_MEMORY``
+    batch ids that touched them, so retrying a batch that failed part way
+    only applies what is still missing. Returns how many stored terms were
+    created since the last compaction.
+    """
+    if UpdateOne is None:
+        raise RuntimeError("pymongo unavailable")
+    ops = []
+    for kind, attr in KINDS.items():
+        for term, count in getattr(stats, attr).items():
+            flt = _marked({"tenant_id": tenant, "kind": kind, "term": term}, batch_id)
+            ops.append(UpdateOne(flt, {"$inc": {"count": count}, "$push": _remember(batch_id)}, upsert=True))
+    batches = [ops[i:i+WRITE_BATCH] for i in range(0, len(ops), WRITE_BATCH)]
+    results = await asyncio.gather(*(_write(db[TERMS], b) for b in batches))
+    inserted = sum(n for n, _ in results)
+    retry = [op for _, dups in results for op in dups]
+    if retry:
+        # A concurrent insert now matches the filter; terms this batch already has still conflict and are done.
+        inserted += (await _write(db[TERMS], retry))[0]
+    inc = {
+        "items": items,
+        "total_tokens_en": stats.en_terms.total(),
+        "total_tokens_th": stats.th_terms.total(),
+        "sentences_en": stats.sentences.get("en", 0),
+        "sentences_th": stats.sentences.get("th", 0),
+        "sentences_mixed": stats.sentences.get("mixed", 0),
+        "switches": stats.switches,
+        "terms_since_compact": inserted,
+    }
+    for pattern, count in stats.patterns.items():
+        inc[f"patterns.{pattern}"] = count
+    update = {"$inc": inc, "$set": {"updated_at": _now()}, "$push": _remember(batch_id)}
+    for _ in range(2):
+        try:
+            doc = await db[STATS].find_one_and_update(
+                _marked({"_id": tenant}, batch_id),
+                update,
+                projection={"terms_since_compact": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            return (doc or {}).get("terms_since_compact", inserted)
+        except DuplicateKeyError:
+            continue
+    # Still conflicting: the stats for this batch were applied by an earlier attempt.
+    doc = await db[STATS].find_one({"_id": tenant}, {"terms_since_compact": 1})
+    return (doc or {}).get("terms_since_compact", inserted)
+
+
+async def load(db, tenant: str, top_k: int) -> MixedCounters:
+    """Rebuild a MixedCounters holding the stored top-k of each kind."""
+    doc = await db[STATS].find_one({"_id": tenant}) or {}
+    totals = {"en_terms": doc.get("total_tokens_en", 0), "th_terms": doc.get("total_tokens_th", 0)}
+
+    async def top(kind: str) -> list[dict]:
+        cursor = db[TERMS].find({"tenant_id": tenant, "kind": kind}, {"_id": 0, "term": 1, "count": 1}, sort=[("count", -1)], limit=top_k)
+        return await cursor.to_list(length=top_k)
+
+    rows = await asyncio.gather(*(top(kind) for kind in KINDS))
+    stats = MixedCounters()
+    for (kind, attr), r in zip(KINDS.items(), rows):
+        setattr(stats, attr, StoredTop(r, totals.get(kind, sum(x["count"] for x in r))))
+    stats.patterns.update(doc.get("patterns") or {})
+    stats.sentences = {"en": doc.get("sentences_en", 0), "th": doc.get("sentences_th", 0), "mixed": doc.get("sentences_mixed", 0)}
+    stats.switches = doc.get("switches", 0)
+    return stats
+
+
+async def compact(db, tenant: str, keep: int) -> dict[str, int]:
+    """Drop every stored term below the keep-th largest count of its kind."""
+    keep = max(1, keep)
+    pruned = {}
+    for kind in KINDS:
+        q = {"tenant_id": tenant, "kind": kind}
+        edge = await db[TERMS].find(q, {"count": 1}, sort=[("count", -1)], skip=keep - 1, limit=1).to_list(length=1)
+        if not edge:
+            pruned[kind] = 0
+            continue
+        res = await db[TERMS].delete_many({**q, "count": {"$lt": edge[0]["count"]}})
+        pruned[kind] = res.deleted_count
+    await db[STATS].update_one({"_id": tenant}, {"$set": {"terms_since_compact": 0, "compacted_at": _now()}})
+    return pruned
+
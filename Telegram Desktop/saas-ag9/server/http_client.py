@@ -0,0 +1,66 @@
+import os
+
+import httpx
+
+
+def _env(name: str, default: str | None = None) -> str | None:
+    v = os.getenv(name)
+    if v is None:
+        return default
+    s = v.strip()
+    if s.startswith("${") and s.endswith("}"):
+        return default
+    return s or default
+
+# Per-upstream defaults: (timeout seconds, max connections, max keep-alive connections).
+# Override with HTTP_<NAME>_TIMEOUT / HTTP_<NAME>_MAX_CONNECTIONS / HTTP_<NAME>_KEEPALIVE.
+DEFAULTS: dict[str, tuple[float, int, int]] = {
+    "coingecko": (4.0, 4, 2),
+    "google": (5.0, 4, 2),
+    "shopify": (10.0, 20, 10),
+    "shopify_bulk": (300.0, 4, 2),
+    "openai": (60.0, 500, 100),
+    "fetch_agent": (8.0, 50, 20),
+}
+FALLBACK = (10.0, 20, 10)
+
+
+class HTTPClients:
+    """One pooled ``httpx.AsyncClient`` per named upstream.
+
+    Each upstream gets its own connection pool, limits and timeouts, so a
+    slow provider cannot exhaust connections needed by another. Clients are
+    created on first use and closed together at app shutdown.
+    """
+
+    def __init__(self) -> None:
+        self._clients: dict[str, httpx.AsyncClient] = {}
+
+    def _build(self, name: str) -> httpx.AsyncClient:
+        timeout, max_conn, keepalive = DEFAULTS.get(name, FALLBACK)
+        key = name.upper()
+        timeout = float(_env(f"HTTP_{key}_TIMEOUT", str(timeout)))
+        limits = httpx.Limits(
+            max_connections=int(_env(f"HTTP_{key}_MAX_CONNECTIONS", str(max_conn))),
+            max_keepalive_connections=int(_env(f"HTTP_{key}_KEEPALIVE", str(keepalive))),
+            keepalive_expiry=30.0,
+        )
+        return httpx.AsyncClient(timeout=httpx.Timeout(timeout, connect=min(timeout, 5.0)), limits=limits)
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._clients[name] = self._build(name)
+        return client
+
+    async def aclose(self) -> None:
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+
+HTTP = HTTPClients()
+
+
+def http_client(name: str) -> httpx.AsyncClient:
+    return HTTP.get(name)
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi import FastAPI, Request, Response, HTTPException, Depends, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from fastapi.responses import PlainTextResponse
@@ -6,14 +6,31 @@ from fastapi.responses import JSONResponse
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import base64
+import functools
+import hashlib
+import json
 import os
-import requests
 from pydantic import BaseModel
-from google.oauth2 import id_token as google_id_token
-from google.auth.transport import requests as google_requests
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from server.auth import verify_supabase_jwt
+from server.auth import verify_supabase_jwt, verify_google_id_token, GOOGLE_CERTS
+from server.analysis import MixedCounters, _env_int, analyze_ndjson, analyze_texts_async, shutdown_pool, sketch_width_for
+from server.sketch import SpaceSaving
+from server import corpus
+from server.cache import TTLCache
+from server.price_feed import PriceRefresher
+from server.http_client import HTTP
+from server import shopify
+from server.analytics import EventBuffer
+from server import analytics
+from server import auth_events
+from server import catalog_sync
+from server.ai_relay import RELAYS, echo_stream
+from server.ai_cache import PromptCache
+from server.ai_router import ProviderRouter
+from server.agents.intents import INTENTS
+from server.agents.base import AgentUnavailable
 from pydantic import BaseModel
 from typing import Optional
 import logging
@@ -27,30 +44,19 @@ try:
     from bson import ObjectId as _ObjectId
 except Exception:
     _ObjectId = None
+try:
+    from pymongo import InsertOne, UpdateOne
+    from pymongo.errors import BulkWriteError
+except Exception:
+    InsertOne = UpdateOne = None
+    BulkWriteError = None
 import asyncio
 try:
     import stripe as _stripe
 except Exception:
     _stripe = None
-try:
-    from prometheus_client import Counter, Histogram, generate_latest, CollectorRegistry
-    METRICS_REGISTRY = CollectorRegistry()
-    HTTP_REQUESTS_TOTAL = Counter(
-        "http_requests_total",
-        "Total HTTP requests",
-        ["method", "status"],
-        registry=METRICS_REGISTRY,
-    )
-    HTTP_REQUEST_DURATION_SECONDS = Histogram(
-        "http_request_duration_seconds",
-        "HTTP request duration in seconds",
-        ["method"],
-        registry=METRICS_REGISTRY,
-    )
-except Exception:
-    METRICS_REGISTRY = None
-    HTTP_REQUESTS_TOTAL = None
-    HTTP_REQUEST_DURATION_SECONDS = None
+from server import metrics as prom
+from server.metrics import METRICS_REGISTRY, HTTP_REQUESTS_TOTAL, HTTP_REQUEST_DURATION_SECONDS, generate_latest
 
 # Pluggable agent provider (Local or Fetch.ai)
 try:
@@ -93,6 +99,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "X-Next-Cursor", "X-Batch-Id"],
 )
 
 
@@ -118,6 +125,9 @@ class GoogleAuthPayload(BaseModel):
 class ShopifyProductQuery(BaseModel):
     product_id: str = Field(..., min_length=1, max_length=64)
 
+class ShopifyProductsQuery(BaseModel):
+    product_ids: list[str] = Field(..., min_length=1, max_length=250)
+
 
 # Agent routing models
 class AgentRoutePayload(BaseModel):
@@ -144,10 +154,19 @@ class ContentItem(BaseModel):
 class MixedAnalysisRequest(BaseModel):
     items: list[ContentItem]
     top_k: int = 50
+    approximate: bool = False
+    sketch_width: Optional[int] = Field(None, ge=1)
+    sketch_epsilon: Optional[float] = Field(None, gt=0, lt=1)
+
+class CorpusIngestRequest(BaseModel):
+    items: list[ContentItem]
+    tenant_id: Optional[str] = None
+    batch_id: Optional[str] = Field(None, min_length=1, max_length=64)
 
 class TermStat(BaseModel):
     term: str
     count: int
+    error: Optional[int] = None
 
 class BilingualPattern(BaseModel):
     pattern: str
@@ -174,6 +193,7 @@ class AIStreamPayload(BaseModel):
     model: Optional[str] = None
     strategy: Optional[str] = "cost"
     tenant_id: Optional[str] = None
+    cache: Optional[bool] = None
 
 class ProviderRouteRequest(BaseModel):
     task: str
@@ -204,6 +224,43 @@ class ItemOut(BaseModel):
     created_at: str
     updated_at: str
 
+class ItemListOut(BaseModel):
+    id: str
+    title: Optional[str] = None
+    content: Optional[str] = None
+    tenant_id: Optional[str] = None
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+
+class ItemBulkOp(BaseModel):
+    op: str = Field(..., pattern="^(create|update|delete)$")
+    id: Optional[str] = None
+    title: Optional[str] = Field(None, min_length=1, max_length=200)
+    content: Optional[str] = Field(None, min_length=1)
+
+class ItemBulkRequest(BaseModel):
+    operations: list[ItemBulkOp] = Field(..., min_length=1, max_length=5000)
+    ordered: bool = False
+    tenant_id: Optional[str] = None
+
+class ItemBulkResult(BaseModel):
+    index: int
+    op: str
+    id: Optional[str] = None
+    status: str
+    error: Optional[str] = None
+
+class ItemBulkResponse(BaseModel):
+    ok: bool
+    ordered: bool
+    inserted: int
+    updated: int
+    deleted: int
+    results: list[ItemBulkResult]
+
+ITEM_FIELDS = ("title", "content", "tenant_id", "created_at", "updated_at")
+ITEMS_MAX_LIMIT = 500
+
 
 STATE: dict[str, object] = {
     "wallet_balance_eth": None,
@@ -216,6 +273,9 @@ STATE: dict[str, object] = {
 def now_iso() -> str:
     return datetime.utcnow().isoformat(timespec="seconds") + "Z"
 
+# /status is served from STATE; ETH price is kept fresh in the background.
+PRICE_FEED = PriceRefresher(STATE, interval=float(_env("ETH_PRICE_REFRESH_SECONDS", "60")))
+
 MONGO_URI = _env("MONGO_URI")
 MONGO_DB = _env("MONGO_DB")
 mongo_client = None
@@ -235,9 +295,43 @@ def get_db():
 async def init_db():
     try:
         db = get_db()
-        await db["auth_events"].create_index("time")
-    except Exception:
-        pass
+    except Exception as e:
+        logging.warning(f"startup database setup skipped: {e}")
+        return
+    steps = [
+        ("auth_events", lambda: auth_events.ensure_collection(db, float(_env("AUTH_EVENTS_RETENTION_DAYS", "90")))),
+        ("items", lambda: db["items"].create_index([("tenant_id", 1), ("_id", -1)])),
+        ("corpus", lambda: corpus.ensure_indexes(db)),
+        ("catalog_sync", lambda: catalog_sync.ensure_indexes(db)),
+        ("analytics", lambda: analytics.ensure_indexes(db, float(_env("ANALYTICS_RETENTION_DAYS", "30")))),
+    ]
+    if ANALYSIS_CACHE_SHARED:
+        steps.append(("analysis_cache", lambda: db["analysis_cache"].create_index("expires_at", expireAfterSeconds=0)))
+    shopify.THROTTLE.attach(db["shopify_throttle"])
+    # Each step runs on its own so one failure does not skip the rest.
+    for name, step in steps:
+        try:
+            await step()
+        except Exception as e:
+            logging.warning(f"startup {name} setup failed: {e}")
+
+@app.on_event("startup")
+async def start_background_tasks():
+    if _env("GOOGLE_OAUTH_CLIENT_ID"):
+        GOOGLE_CERTS.start()
+    PRICE_FEED.start()
+
+@app.on_event("shutdown")
+async def close_pools():
+    shutdown_pool()
+    await GOOGLE_CERTS.stop()
+    await PRICE_FEED.stop()
+    await catalog_sync.CATALOG_SYNC.stop()
+    await shopify.PRODUCT_CACHE.stop()
+    await ANALYTICS.stop(timeout=float(_env("ANALYTICS_DRAIN_SECONDS", "10")))
+    if AGENT:
+        AGENT.close()
+    await HTTP.aclose()
 
 
 # Serve SPA (built Vite assets in ../dist)
@@ -300,22 +394,7 @@ def metrics():
 
 
 @app.get("/status")
-def get_status():
-    # Optionally enrich ETH price from CoinGecko if missing
-    if STATE.get("eth_price_usd") in (None, 0):
-        try:
-            r = requests.get(
-                "https://api.coingecko.com/api/v3/simple/price",
-                params={"ids": "ethereum", "vs_currencies": "usd"},
-                timeout=4,
-            )
-            if r.ok:
-                price = r.json().get("ethereum", {}).get("usd")
-                if isinstance(price, (int, float)):
-                    STATE["eth_price_usd"] = float(price)
-                    STATE["last_updated"] = now_iso()
-        except Exception:
-            pass
+async def get_status():
     return STATE
 
 
@@ -335,24 +414,44 @@ async def post_auth_event(payload: AuthEvent, request: Request, db=Depends(get_d
         "time": payload.time or now_iso(),
         "source": "next_app",
     }
+    # Stored by receive time (ts) with the event type as time-series metadata.
+    stored = {"ts": datetime.utcnow(), "meta": {"event": doc["event"], "source": doc["source"]}, "metadata": doc["metadata"], "time": doc["time"]}
     try:
-        await db["auth_events"].insert_one(doc)
+        await db[auth_events.COLLECTION].insert_one(stored)
     except Exception:
         pass
     STATE["last_auth_event"] = doc
     STATE["last_updated"] = now_iso()
     return {"ok": True, "received": payload.event}
 
+AUTH_EVENTS_MAX_LIMIT = 200
+
 @app.get("/auth-events")
-async def list_auth_events(limit: int = 20, db=Depends(get_db)):
+async def list_auth_events(
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    event: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db=Depends(get_db),
+):
+    """Newest auth events first; pass ``next_cursor`` back as ``cursor`` for the next page."""
+    limit = max(1, min(limit, AUTH_EVENTS_MAX_LIMIT))
+    start = start.astimezone(timezone.utc).replace(tzinfo=None) if start and start.tzinfo else start
+    end = end.astimezone(timezone.utc).replace(tzinfo=None) if end and end.tzinfo else end
     try:
-        cursor = db["auth_events"].find({}, sort=[("_id", -1)], limit=limit)
-        items = await cursor.to_list(length=limit)
-        for x in items:
-            x["_id"] = str(x["_id"])
-        return {"ok": True, "items": items}
+        flt = auth_events.page_filter(event, start, end, cursor)
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid_cursor")
+    try:
+        rows = await db[auth_events.COLLECTION].find(flt, sort=[("ts", -1), ("_id", -1)], limit=limit + 1).to_list(length=limit + 1)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"db_list_error: {e}")
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = auth_events.encode_cursor(rows[-1])
+    return {"ok": True, "items": [auth_events.to_item(r) for r in rows], "next_cursor": next_cursor}
 
 @app.get("/db/health")
 async def db_health(db=Depends(get_db)):
@@ -408,19 +507,169 @@ async def create_item(payload: ItemCreate, db=Depends(get_db), credentials: HTTP
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"db_insert_error: {e}")
 
-@app.get("/items", response_model=list[ItemOut])
-async def list_items(limit: int = 50, tenant_id: Optional[str] = None, db=Depends(get_db), credentials: HTTPAuthorizationCredentials = Depends(security)):
+def _encode_cursor(oid) -> str:
+    raw = oid.binary if hasattr(oid, "binary") else str(oid).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str):
+    try:
+        raw = base64.b64decode(cursor + "=" * (-len(cursor) % 4), altchars=b"-_", validate=True)
+        if _ObjectId is not None:
+            return _ObjectId(raw)
+        if not raw:
+            raise ValueError(cursor)
+        return raw.decode("utf-8")
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid_cursor")
+
+@app.get("/items", response_model=list[ItemListOut], response_model_exclude_unset=True)
+async def list_items(response: Response, limit: int = 50, tenant_id: Optional[str] = None, cursor: Optional[str] = None, fields: Optional[str] = None, db=Depends(get_db), credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """List a tenant's items newest first.
+
+    Pages are keyed on ``_id``: pass the previous response's ``X-Next-Cursor``
+    header as ``cursor`` to continue. ``fields`` (comma separated) limits the
+    returned attributes and is applied as a Mongo projection.
+    """
     claims = _claims(credentials)
     tenant = tenant_id or claims.get("tenant_id") or "default"
+    limit = max(1, min(limit, ITEMS_MAX_LIMIT))
+    wanted = ITEM_FIELDS
+    if fields:
+        wanted = tuple(f.strip() for f in fields.split(",") if f.strip() and f.strip() != "id")
+        if any(f not in ITEM_FIELDS for f in wanted):
+            raise HTTPException(status_code=400, detail="invalid_fields")
+    query: dict = {"tenant_id": tenant}
+    if cursor:
+        query["_id"] = {"$lt": _decode_cursor(cursor)}
     try:
-        cursor = db["items"].find({"tenant_id": tenant}, sort=[("_id", -1)], limit=limit)
-        rows = await cursor.to_list(length=limit)
-        out = []
-        for r in rows:
-            out.append(ItemOut(id=str(r.get("_id")), title=r.get("title"), content=r.get("content"), tenant_id=r.get("tenant_id"), created_at=r.get("created_at"), updated_at=r.get("updated_at")))
-        return out
+        # One extra row tells us whether another page exists without a count.
+        rows = await db["items"].find(query, projection=dict.fromkeys(wanted, 1) or {"_id": 1}, sort=[("_id", -1)], limit=limit + 1).to_list(length=limit + 1)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"db_list_error: {e}")
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = _encode_cursor(rows[-1]["_id"])
+    return [ItemListOut(id=str(r["_id"]), **{f: r.get(f) for f in wanted}) for r in rows]
+
+# Write error raised by an upsert whose $setOnInsert changes the _id fixed by its filter.
+IMMUTABLE_FIELD = 66
+
+
+def _bulk_item_op(op: ItemBulkOp, tenant: str, now: str, token: str):
+    """Translate one bulk operation into ``(pymongo request, item _id)``; raises ValueError if it is invalid.
+
+    Updates and deletes are upserts that can never insert: when the filter
+    misses, ``$setOnInsert`` contradicts the ``_id`` it fixes, so the server
+    reports that operation alone as a write error (``not_found``). Deletes
+    mark the item with ``token`` and are removed together after the batch.
+    """
+    if op.op == "create":
+        if not op.title or not op.content:
+            raise ValueError("title_and_content_required")
+        oid = _ObjectId()
+        return InsertOne({"_id": oid, "title": op.title, "content": op.content, "tenant_id": tenant, "created_at": now, "updated_at": now}), oid
+    if not op.id:
+        raise ValueError("id_required")
+    try:
+        oid = _ObjectId(op.id)
+    except Exception:
+        raise ValueError("invalid_id")
+    # Ownership is part of the filter, so another tenant's item simply does not match;
+    # neither does one deleted earlier in the batch.
+    flt = {"_id": oid, "tenant_id": tenant, "_bulk_deleting": {"$exists": False}}
+    if op.op == "delete":
+        fields = {"_bulk_deleting": token}
+    else:
+        fields = {k: v for k, v in (("title", op.title), ("content", op.content)) if v is not None}
+        if not fields:
+            raise ValueError("empty_update")
+        fields["updated_at"] = now
+    return UpdateOne(flt, {"$set": fields, "$setOnInsert": {"_id": _ObjectId()}}, upsert=True), oid
+
+@app.post("/items/bulk", response_model=ItemBulkResponse, response_model_exclude_none=True)
+async def bulk_items(payload: ItemBulkRequest, db=Depends(get_db), credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Create, update and delete many items with ``bulk_write``, without reading them first.
+
+    In ordered mode the first failing operation stops the batch and later
+    ones are reported as ``skipped``; unordered batches apply every valid
+    operation. Updates and deletes only match items owned by the tenant and
+    report ``not_found`` otherwise. Each status comes from that operation's
+    own write result. An ordered batch is resubmitted after each
+    ``not_found``, so misses cost a round trip each in that mode.
+    """
+    claims = _claims(credentials)
+    tenant = payload.tenant_id or claims.get("tenant_id") or "default"
+    if InsertOne is None or _ObjectId is None:
+        raise HTTPException(status_code=500, detail="pymongo_unavailable")
+    now = _now()
+    token = uuid4().hex
+    results = [ItemBulkResult(index=i, op=op.op, id=op.id, status="skipped") for i, op in enumerate(payload.operations)]
+    requests_, positions = [], []
+    for i, op in enumerate(payload.operations):
+        try:
+            req, oid = _bulk_item_op(op, tenant, now, token)
+        except ValueError as e:
+            results[i].status, results[i].error = "invalid", str(e)
+            if payload.ordered:
+                break
+            continue
+        results[i].id = str(oid)
+        requests_.append(req)
+        positions.append(i)
+    inserted = 0
+    placeholders = []
+    done = 0
+    while done < len(requests_):
+        batch = requests_[done:]
+        errors: dict[int, dict] = {}
+        upserted: dict[int, object] = {}
+        try:
+            res = await db["items"].bulk_write(batch, ordered=payload.ordered)
+            inserted += res.inserted_count
+            upserted = res.upserted_ids or {}
+        except Exception as e:
+            if BulkWriteError is None or not isinstance(e, BulkWriteError):
+                raise HTTPException(status_code=500, detail=f"db_bulk_error: {e}")
+            inserted += e.details.get("nInserted", 0)
+            upserted = {u["index"]: u["_id"] for u in e.details.get("upserted", [])}
+            errors = {w["index"]: w for w in e.details.get("writeErrors", [])}
+        # A server that let the contradictory upsert through still signals the miss; drop what it inserted.
+        placeholders += upserted.values()
+        stop = min(errors) if payload.ordered and errors else len(batch)
+        for n, req in enumerate(batch[:stop + 1]):
+            r = results[positions[done + n]]
+            if n in errors:
+                missed = errors[n].get("code") == IMMUTABLE_FIELD
+                r.status, r.error = ("not_found", None) if missed else ("error", errors[n].get("errmsg", "write_error"))
+            elif n in upserted:
+                r.status = "not_found"
+            else:
+                r.status = {"create": "created", "update": "updated", "delete": "deleted"}[r.op]
+        if stop < len(batch) and errors[stop].get("code") != IMMUTABLE_FIELD:
+            break
+        done += stop + 1
+    deleted = 0
+    try:
+        if placeholders:
+            await db["items"].delete_many({"_id": {"$in": placeholders}})
+        if any(r.status == "deleted" for r in results):
+            deleted = (await db["items"].delete_many({"_bulk_deleting": token})).deleted_count
+    except Exception as e:
+        try:
+            await db["items"].update_many({"_bulk_deleting": token}, {"$unset": {"_bulk_deleting": ""}})
+        except Exception as e2:
+            logging.warning(f"bulk delete marks {token} not cleared: {e2}")
+        for r in results:
+            if r.status == "deleted":
+                r.status, r.error = "error", f"db_bulk_error: {e}"
+    return ItemBulkResponse(
+        ok=all(r.status in ("created", "updated", "deleted") for r in results),
+        ordered=payload.ordered,
+        inserted=inserted,
+        updated=sum(r.status == "updated" for r in results),
+        deleted=deleted,
+        results=results,
+    )
 
 @app.get("/items/{item_id}", response_model=ItemOut)
 async def get_item(item_id: str, db=Depends(get_db), credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -481,37 +730,8 @@ async def delete_item(item_id: str, db=Depends(get_db), credentials: HTTPAuthori
 @app.post("/chat")
 async def chat(payload: ChatPayload):
     """Simple rule-based chat responses for customer service."""
-    user = (payload.message or "").strip().lower()
     lang = (payload.lang or "").lower()
-    # Very simple intent detection
-    def reply_en():
-        if any(k in user for k in ["hi", "hello", "hey"]):
-            return "Hello! How can I help you today?"
-        if "price" in user or "pricing" in user:
-            return "Our pricing is flexible. Check the Pricing section or ask me specifics."
-        if "trial" in user or "free" in user:
-            return "We offer a free 7‑day trial. Want me to guide you to sign up?"
-        if "contact" in user or "support" in user:
-            return "You can reach support via the Contact section or chat here anytime."
-        if "hours" in user or "24" in user:
-            return "Our AI runs 24/7; human support replies during business hours."
-        return "Got it. I’m here to help—could you share more details?"
-
-    def reply_th():
-        if any(k in user for k in ["สวัสดี", "ไฮ", "เฮ้"]):
-            return "สวัสดีค่ะ/ครับ มีอะไรให้ช่วยไหมคะ/ครับ?"
-        if "ราคา" in user:
-            return "ราคาและแพ็กเกจดูได้ที่หน้า Pricing หรือถามรายละเอียดได้เลยค่ะ/ครับ"
-        if "ทดลอง" in user or "ฟรี" in user:
-            return "มีทดลองใช้ฟรี 7 วัน สนใจให้ช่วยสมัครไหมคะ/ครับ?"
-        if "ติดต่อ" in user or "ซัพพอร์ต" in user:
-            return "ติดต่อทีมงานได้ที่หน้า Contact หรือคุยกับบอทได้ที่นี่ค่ะ/ครับ"
-        if "24" in user or "ชั่วโมง" in user:
-            return "ระบบ AI ทำงาน 24 ชั่วโมง ส่วนทีมงานตอบในเวลาทำการค่ะ/ครับ"
-        return "รับทราบค่ะ/ครับ บอกเพิ่มเติมได้เลยนะคะ/ครับว่าต้องการอะไร"
-
-    is_en = lang.startswith("en") if lang else False
-    text = reply_en() if is_en else reply_th()
+    _, text = INTENTS.match(payload.message, lang)
     return {"reply": text, "lang": lang or "th", "session_id": payload.session_id}
 
 
@@ -519,14 +739,13 @@ async def chat(payload: ChatPayload):
 
 
 @app.post("/auth/google")
-def auth_google(payload: GoogleAuthPayload):
-    """Verify Google ID token directly via Google public keys."""
+async def auth_google(payload: GoogleAuthPayload):
+    """Verify Google ID token against cached Google public keys."""
     client_id = _env("GOOGLE_OAUTH_CLIENT_ID")
     if not client_id:
         raise HTTPException(status_code=500, detail="Server missing GOOGLE_OAUTH_CLIENT_ID")
     try:
-        request = google_requests.Request()
-        decoded = google_id_token.verify_oauth2_token(payload.id_token, request, audience=client_id)
+        decoded = await verify_google_id_token(payload.id_token, client_id)
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Invalid Google token: {e}")
 
@@ -593,92 +812,98 @@ def auth_me(credentials: HTTPAuthorizationCredentials = Depends(security)):
 
 # --- Shopify proxy endpoints ---
 @app.post("/shopify/product")
-def shopify_product(payload: ShopifyProductQuery):
-    shop = os.getenv("SHOPIFY_SHOP")
-    token = os.getenv("SHOPIFY_ACCESS_TOKEN")
-    if not shop or not token:
+async def shopify_product(payload: ShopifyProductQuery, response: Response):
+    if not shopify.configured():
         raise HTTPException(status_code=500, detail="Shopify not configured")
+    gid = shopify.product_gid(payload.product_id)
+    if not shopify.valid_product_gid(gid):
+        raise HTTPException(status_code=400, detail="invalid_product_id")
+    product, cache_status = await shopify.PRODUCT_CACHE.get(gid)
+    response.headers["X-Cache"] = cache_status.upper()
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return product
 
-    url = f"https://{shop}/admin/api/2024-10/graphql.json"
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": token,
-    }
+SHOPIFY_BATCH_MAX_COST = int(_env("SHOPIFY_BATCH_MAX_COST", "1000"))
+SHOPIFY_BATCH_CONCURRENCY = int(_env("SHOPIFY_BATCH_CONCURRENCY", "4"))
 
-    gid = payload.product_id
-    if gid.isdigit():
-        gid = f"gid://shopify/Product/{gid}"
-
-    query = {
-        "query": f"""
-        {{
-          product(id: \"{gid}\") {{
-            id
-            title
-            handle
-            descriptionHtml
-            vendor
-            productType
-            tags
-            status
-            totalInventory
-            variants(first: 50) {{
-              edges {{
-                node {{
-                  id
-                  title
-                  sku
-                  barcode
-                  price
-                  inventoryQuantity
-                  inventoryItem {{
-                    id
-                    tracked
-                    measurement {{
-                      weight {{
-                        unit
-                        value
-                      }}
-                    }}
-                  }}
-                }}
-              }}
-            }}
-            images(first: 10) {{
-              edges {{
-                node {{
-                  url
-                  altText
-                }}
-              }}
-            }}
-          }}
-        }}
-        """
-    }
+@app.post("/shopify/products")
+async def shopify_products(payload: ShopifyProductsQuery):
+    if not shopify.configured():
+        raise HTTPException(status_code=500, detail="Shopify not configured")
+    gids = [shopify.product_gid(pid) for pid in payload.product_ids if pid.strip()]
+
+    async def rows():
+        async for group in shopify.PRODUCT_CACHE.get_many(gids, SHOPIFY_BATCH_MAX_COST, SHOPIFY_BATCH_CONCURRENCY):
+            yield "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in group).encode("utf-8")
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
 
+@app.post("/shopify/webhooks/products")
+async def shopify_product_webhook(request: Request):
+    """Invalidate cached products on Shopify products/update and products/delete webhooks."""
+    body = await request.body()
+    shopify.verify_webhook(body, request.headers.get("X-Shopify-Hmac-Sha256"))
     try:
-        r = requests.post(url, json=query, headers=headers, timeout=10)
+        data = json.loads(body or b"{}")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid_json")
+    gid = shopify.webhook_product_gid(data) if isinstance(data, dict) else None
+    if not gid:
+        return {"ok": True, "invalidated": None}
+    shopify.PRODUCT_CACHE.invalidate(gid)
+    if request.headers.get("X-Shopify-Topic") == "products/delete":
+        # Incremental syncs only see updates, so deletions are applied to the local catalog here.
+        try:
+            await catalog_sync.delete_product(get_db(), gid)
+        except Exception as e:
+            logging.warning(f"catalog delete for {gid} failed: {e}")
+    return {"ok": True, "invalidated": gid}
+
+def _sync_job(job: dict) -> dict:
+    job = dict(job)
+    job["job_id"] = job.pop("_id")
+    return job
+
+@app.post("/shopify/sync", status_code=202)
+async def shopify_sync_start(full: bool = False, credentials: HTTPAuthorizationCredentials = Depends(security), db=Depends(get_db)):
+    _ = _claims(credentials)
+    if not shopify.configured():
+        raise HTTPException(status_code=500, detail="Shopify not configured")
+    try:
+        job = await catalog_sync.CATALOG_SYNC.start(db, full=full)
+    except catalog_sync.SyncInProgress as e:
+        raise HTTPException(status_code=409, detail=f"sync_in_progress: {e.job_id}")
     except Exception as e:
-        raise HTTPException(status_code=502, detail=f"Shopify request failed: {e}")
-    if not r.ok:
-        raise HTTPException(status_code=r.status_code, detail=r.text)
-    body = r.json()
-    product = (body.get("data") or {}).get("product")
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    return product
+        raise HTTPException(status_code=500, detail=f"sync_start_error: {e}")
+    return _sync_job(job)
+
+@app.get("/shopify/sync")
+async def shopify_sync_status(job_id: Optional[str] = None, credentials: HTTPAuthorizationCredentials = Depends(security), db=Depends(get_db)):
+    _ = _claims(credentials)
+    try:
+        job = await db[catalog_sync.JOBS].find_one({"_id": job_id}) if job_id else await catalog_sync.CATALOG_SYNC.latest_job(db)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"db_read_error: {e}")
+    if not job:
+        raise HTTPException(status_code=404, detail="sync_job_not_found")
+    return _sync_job(job)
 
 application = app
 
 # --- Agent routing endpoints ---
 
+def _agent_unavailable(e: AgentUnavailable) -> HTTPException:
+    if e.reason == "busy":
+        return HTTPException(status_code=503, detail="agent_busy", headers={"Retry-After": "1"})
+    return HTTPException(status_code=504, detail="agent_timeout")
+
 @app.get("/agent/status")
-def agent_status():
+async def agent_status():
     """Return basic status of the local agent service (stub)."""
     try:
         if AGENT:
-            status = AGENT.status()
+            status = await AGENT.status()
         else:
             status = {
                 "name": "rule_based_agent",
@@ -687,6 +912,8 @@ def agent_status():
                 "time": now_iso(),
             }
         return {"ok": True, "agent": status}
+    except AgentUnavailable as e:
+        raise _agent_unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Agent status error: {e}")
 
@@ -706,41 +933,13 @@ async def agent_route(payload: AgentRoutePayload):
 
     try:
         if AGENT:
-            result = AGENT.respond(message=message, lang=lang, session_id=payload.session_id, tenant_id=payload.tenant_id)
+            result = await AGENT.respond(message=message, lang=lang, session_id=payload.session_id, tenant_id=payload.tenant_id)
             reply = result.get("reply") or ""
             lang_out = result.get("lang") or lang or "en"
         else:
-            # Fallback to same rule-based logic as /chat
-            def reply_en():
-                m = message.lower()
-                if any(k in m for k in ["hi", "hello", "hey"]):
-                    return "Hello! How can I help you today?"
-                if "price" in m or "pricing" in m:
-                    return "Our pricing is flexible. Check the Pricing section or ask me specifics."
-                if "trial" in m or "free" in m:
-                    return "We offer a free 7‑day trial. Want me to guide you to sign up?"
-                if "contact" in m or "support" in m:
-                    return "You can reach support via the Contact section or chat here anytime."
-                if "hours" in m or "24" in m:
-                    return "Our AI runs 24/7; human support replies during business hours."
-                return "Got it. I’m here to help—could you share more details?"
-
-            def reply_th():
-                m = message.lower()
-                if any(k in m for k in ["สวัสดี", "ไฮ", "เฮ้"]):
-                    return "สวัสดีค่ะ/ครับ มีอะไรให้ช่วยไหมคะ/ครับ?"
-                if "ราคา" in m:
-                    return "ราคาและแพ็กเกจดูได้ที่หน้า Pricing หรือถามรายละเอียดได้เลยค่ะ/ครับ"
-                if "ทดลอง" in m or "ฟรี" in m:
-                    return "มีทดลองใช้ฟรี 7 วัน สนใจให้ช่วยสมัครไหมคะ/ครับ?"
-                if "ติดต่อ" in m or "ซัพพอร์ต" in m:
-                    return "ติดต่อทีมงานได้ที่หน้า Contact หรือคุยกับบอทได้ที่นี่ค่ะ/ครับ"
-                if "24" in m or "ชั่วโมง" in m:
-                    return "ระบบ AI ทำงาน 24 ชั่วโมง ส่วนทีมงานตอบในเวลาทำการค่ะ/ครับ"
-                return "รับทราบค่ะ/ครับ บอกเพิ่มเติมได้เลยนะคะ/ครับว่าต้องการอะไร"
-
+            # Fallback to the same intent table as /chat
+            _, reply = INTENTS.match(message, lang)
             is_en = lang.startswith("en") if lang else False
-            reply = reply_en() if is_en else reply_th()
             lang_out = lang or ("en" if is_en else "th")
 
         return AgentRouteResponse(
@@ -749,76 +948,52 @@ async def agent_route(payload: AgentRoutePayload):
             session_id=payload.session_id,
             tenant_id=payload.tenant_id,
         )
+    except AgentUnavailable as e:
+        raise _agent_unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Agent routing error: {e}")
 
 
 # --- Unified AI orchestration ---
 
+# Routing uses rolling TTFT, throughput and error stats from /ai/stream traffic,
+# with a circuit breaker per model.
+AI_ROUTER = ProviderRouter(
+    alpha=float(_env("AI_ROUTER_ALPHA", "0.2")),
+    failure_threshold=int(_env("AI_ROUTER_FAILURES", "3")),
+    cooldown=float(_env("AI_ROUTER_COOLDOWN", "30")),
+    min_samples=_env_int("AI_ROUTER_MIN_SAMPLES", 3),
+    explore_rate=float(_env("AI_ROUTER_EXPLORE_RATE", "0.05")),
+)
+
+
 def _choose_provider(req: ProviderRouteRequest) -> ProviderRouteResponse:
-    allow = [p.lower() for p in (req.allow or ["openai","anthropic","google"])]
-    prices = {
-        "openai": {"gpt-4o-mini": 0.005},
-        "anthropic": {"claude-3-haiku": 0.008},
-        "google": {"gemini-1.5-flash": 0.002},
-    }
-    best_provider = None
-    best_model = None
-    best_price = 1e9
-    for p in allow:
-        if p in prices:
-            models = prices[p]
-            for m, c in models.items():
-                if req.priority == "speed":
-                    score = c * 1.1
-                else:
-                    score = c
-                if score < best_price:
-                    best_price = score
-                    best_provider = p
-                    best_model = m
-    if not best_provider:
-        best_provider = "openai"
-        best_model = "gpt-4o-mini"
-    return ProviderRouteResponse(provider=best_provider, model=best_model, reason="heuristic_selection")
+    provider, model, reason = AI_ROUTER.choose(req.priority, req.allow, req.max_tokens or 2048)
+    return ProviderRouteResponse(provider=provider, model=model, reason=reason)
 
 @app.post("/ai/route", response_model=ProviderRouteResponse)
 def ai_route(payload: ProviderRouteRequest, credentials: HTTPAuthorizationCredentials = Depends(security)):
     _ = _claims(credentials)
     return _choose_provider(payload)
 
-def _sse_format(data: str) -> bytes:
-    return ("data: " + data + "\n\n").encode("utf-8")
-
-def _stream_openai(prompt: str, model: str):
-    key = os.getenv("OPENAI_API_KEY")
-    if not key:
-        async def _fake():
-            for w in prompt.split():
-                yield _sse_format(w)
-                await asyncio.sleep(0.05)
-            yield _sse_format("[DONE]")
-        return _fake()
-    url = "https://api.openai.com/v1/chat/completions"
-    headers = {"Authorization": f"Bearer {key}", "Content-Type": "application/json"}
-    body = {"model": model, "messages": [{"role": "user", "content": prompt}], "stream": True}
-    def gen():
-        try:
-            r = requests.post(url, headers=headers, json=body, stream=True, timeout=60)
-            for line in r.iter_lines():
-                if not line:
-                    continue
-                try:
-                    yield line + b"\n\n"
-                except Exception:
-                    pass
-        except Exception:
-            yield _sse_format("error")
-            yield _sse_format("[DONE]")
-    return gen()
+@app.get("/ai/route")
+def ai_route_stats(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    _ = _claims(credentials)
+    return {"models": AI_ROUTER.snapshot()}
+
+# Completed streams are replayed for identical (provider, model, prompt) requests,
+# and concurrent identical requests share one upstream call.
+AI_CACHE = PromptCache(
+    ttl=float(_env("AI_CACHE_TTL", "3600")),
+    max_bytes=int(_env("AI_CACHE_MAX_MB", "64")) * 1024 * 1024,
+    max_entries=int(_env("AI_CACHE_MAX_ENTRIES", "10000")),
+)
+AI_CACHE_ENABLED = (_env("AI_CACHE_ENABLED", "1") or "").lower() in ("1", "true", "yes")
+AI_CACHE_OPT_OUT_TENANTS = {t.strip() for t in (_env("AI_CACHE_OPT_OUT_TENANTS") or "").split(",") if t.strip()}
+
 
 @app.post("/ai/stream")
-def ai_stream(payload: AIStreamPayload, credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def ai_stream(payload: AIStreamPayload, credentials: HTTPAuthorizationCredentials = Depends(security)):
     claims = _claims(credentials)
     tenant = payload.tenant_id or claims.get("tenant_id") or "default"
     provider = (payload.provider or "").lower()
@@ -828,19 +1003,22 @@ def ai_stream(payload: AIStreamPayload, credentials: HTTPAuthorizationCredential
         model = sel.model
     else:
         model = payload.model or ("gpt-4o-mini" if provider == "openai" else "gemini-1.5-flash")
-    if provider == "openai":
-        gen = _stream_openai(payload.prompt, model)
+    if provider in RELAYS:
+        label = model if AI_ROUTER.routable(provider, model) else "other"
+        factory = functools.partial(RELAYS[provider], payload.prompt, model, metric_model=label)
     else:
-        async def fake():
-            for w in payload.prompt.split():
-                yield _sse_format(w)
-                await asyncio.sleep(0.05)
-            yield _sse_format("[DONE]")
-        gen = fake()
+        factory = functools.partial(echo_stream, payload.prompt)
+    factory = AI_ROUTER.track(provider, model, factory)
+    if AI_CACHE_ENABLED and payload.cache is not False and tenant not in AI_CACHE_OPT_OUT_TENANTS:
+        cache_status, gen = AI_CACHE.open(PromptCache.key(provider, model, payload.prompt), factory)
+    else:
+        cache_status, gen = "BYPASS", factory(None)
     headers = {
         "Content-Type": "text/event-stream",
         "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
         "X-Tenant": tenant,
+        "X-Cache": cache_status,
     }
     return StreamingResponse(gen, media_type="text/event-stream", headers=headers)
 
@@ -922,133 +1100,219 @@ class AnalyticsEvent(BaseModel):
     props: dict | None = None
     tenant_id: Optional[str] = None
 
-@app.post("/analytics/events")
+# Events are acknowledged once queued and written to Mongo in batches.
+ANALYTICS = EventBuffer(
+    max_queue=int(_env("ANALYTICS_QUEUE_MAX", "50000")),
+    batch_size=int(_env("ANALYTICS_BATCH_SIZE", "500")),
+    flush_interval=float(_env("ANALYTICS_FLUSH_SECONDS", "1")),
+    rollup_days={
+        "minute": float(_env("ANALYTICS_ROLLUP_MINUTE_DAYS", "7")),
+        "hour": float(_env("ANALYTICS_ROLLUP_HOUR_DAYS", "90")),
+        "day": float(_env("ANALYTICS_ROLLUP_DAY_DAYS", "0")),
+    },
+)
+ANALYTICS_MAX_BATCH = 1000
+# Points a single rollup query may return.
+ANALYTICS_MAX_POINTS = 10000
+
+def _analytics_doc(evt: AnalyticsEvent, claims: dict) -> dict:
+    tenant = evt.tenant_id or claims.get("tenant_id") or "default"
+    # created_at is a real datetime so the TTL index can expire raw events.
+    return {"name": evt.name, "props": evt.props or {}, "tenant_id": tenant, "time": now_iso(), "created_at": datetime.utcnow()}
+
+@app.post("/analytics/events", status_code=202)
 async def analytics_events(evt: AnalyticsEvent, db=Depends(get_db), credentials: HTTPAuthorizationCredentials = Depends(security)):
     claims = _claims(credentials)
-    tenant = evt.tenant_id or claims.get("tenant_id") or "default"
-    doc = {"name": evt.name, "props": evt.props or {}, "tenant_id": tenant, "time": now_iso()}
+    accepted = ANALYTICS.submit(db, [_analytics_doc(evt, claims)])
+    return {"ok": accepted == 1, "accepted": accepted}
+
+@app.post("/analytics/events/batch", status_code=202)
+async def analytics_events_batch(events: list[AnalyticsEvent], db=Depends(get_db), credentials: HTTPAuthorizationCredentials = Depends(security)):
+    claims = _claims(credentials)
+    if len(events) > ANALYTICS_MAX_BATCH:
+        raise HTTPException(status_code=413, detail="batch_too_large")
+    accepted = ANALYTICS.submit(db, [_analytics_doc(evt, claims) for evt in events])
+    return {"ok": accepted == len(events), "accepted": accepted, "dropped": len(events) - accepted}
+
+@app.get("/analytics/rollups")
+async def analytics_rollups(
+    granularity: str = "hour",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    name: Optional[str] = None,
+    tenant_id: Optional[str] = None,
+    db=Depends(get_db),
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+):
+    """Event counts per bucket, read from the rollups only (never the raw events)."""
+    claims = _claims(credentials)
+    tenant = tenant_id or claims.get("tenant_id") or "default"
+    if granularity not in analytics.GRANULARITIES:
+        raise HTTPException(status_code=400, detail="invalid_granularity")
+    # Buckets are stored as naive UTC datetimes.
+    end = (end.astimezone(timezone.utc).replace(tzinfo=None) if end and end.tzinfo else end) or datetime.utcnow()
+    start = (start.astimezone(timezone.utc).replace(tzinfo=None) if start and start.tzinfo else start) or end - timedelta(days=1)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="invalid_range")
     try:
-        await db["analytics_events"].insert_one(doc)
+        rows = await analytics.query_rollups(db, tenant, granularity, start, end, name, limit=ANALYTICS_MAX_POINTS + 1)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"db_insert_error: {e}")
-    return {"ok": True}
+        raise HTTPException(status_code=500, detail=f"db_query_error: {e}")
+    if len(rows) > ANALYTICS_MAX_POINTS:
+        raise HTTPException(status_code=400, detail="range_too_large")
+    points = [{"bucket": r["bucket"].isoformat(timespec="seconds") + "Z", "name": r["name"], "count": r["count"]} for r in rows]
+    return {"tenant_id": tenant, "granularity": granularity, "start": start.isoformat(timespec="seconds") + "Z", "end": end.isoformat(timespec="seconds") + "Z", "points": points}
+
+# Identical request bodies (ETL retries, dashboard refreshes) are served from cache.
+ANALYSIS_CACHE = TTLCache(
+    max_entries=int(_env("ANALYSIS_CACHE_MAX_ENTRIES", "1024")),
+    max_bytes=int(_env("ANALYSIS_CACHE_MAX_MB", "64")) * 1024 * 1024,
+    ttl=float(_env("ANALYSIS_CACHE_TTL", "600")),
+)
+# Optionally share results across workers through Mongo (TTL-indexed analysis_cache).
+ANALYSIS_CACHE_SHARED = (_env("ANALYSIS_CACHE_SHARED") or "").lower() in ("1", "true", "mongo")
+ANALYSIS_CACHE_LOOKUPS = prom.counter("analysis_cache_lookups_total", "Mixed-content analysis cache lookups", ["result"])
+ANALYSIS_CACHE_BYTES = prom.gauge("analysis_cache_bytes", "Bytes held by the local mixed-content analysis cache")
+
+def _analysis_cache_key(req: MixedAnalysisRequest, width: Optional[int]) -> str:
+    # Item type does not affect the result and surrounding whitespace never reaches a token.
+    h = hashlib.sha256(f"{max(1, req.top_k)}|{width or 0}|".encode())
+    for item in req.items:
+        b = item.text.strip().encode("utf-8")
+        h.update(len(b).to_bytes(8, "little"))
+        h.update(b)
+    return h.hexdigest()
+
+async def _analysis_cache_get(key: str) -> Optional[MixedAnalysisResponse]:
+    hit = ANALYSIS_CACHE.get(key)
+    if hit is not None:
+        prom.inc(ANALYSIS_CACHE_LOOKUPS, result="hit_local")
+        return hit
+    if ANALYSIS_CACHE_SHARED:
+        try:
+            doc = await get_db()["analysis_cache"].find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}})
+        except Exception:
+            doc = None
+        if doc:
+            resp = MixedAnalysisResponse(**doc["value"])
+            ANALYSIS_CACHE.set(key, resp, size=len(resp.json()))
+            prom.inc(ANALYSIS_CACHE_LOOKUPS, result="hit_shared")
+            return resp
+    prom.inc(ANALYSIS_CACHE_LOOKUPS, result="miss")
+    return None
+
+async def _analysis_cache_set(key: str, resp: MixedAnalysisResponse):
+    ANALYSIS_CACHE.set(key, resp, size=len(resp.json()))
+    prom.set_value(ANALYSIS_CACHE_BYTES, ANALYSIS_CACHE.nbytes)
+    if ANALYSIS_CACHE_SHARED:
+        try:
+            doc = {"value": resp.dict(exclude_none=True), "expires_at": datetime.utcnow() + timedelta(seconds=ANALYSIS_CACHE.ttl)}
+            await get_db()["analysis_cache"].replace_one({"_id": key}, doc, upsert=True)
+        except Exception as e:
+            logging.warning(f"analysis cache write failed: {e}")
 
-def _is_thai_char(ch: str) -> bool:
-    c = ord(ch)
-    return 0x0E00 <= c <= 0x0E7F
-
-def _lang_of_text(text: str) -> str:
-    total = len(text)
-    if total == 0:
-        return "en"
-    thai = sum(1 for ch in text if _is_thai_char(ch))
-    latin = sum(1 for ch in text if ("A" <= ch <= "Z") or ("a" <= ch <= "z"))
-    if thai > 0 and latin == 0:
-        return "th"
-    if latin > 0 and thai == 0:
-        return "en"
-    if thai == 0 and latin == 0:
-        return "en"
-    return "mixed"
-
-def _split_sentences(text: str) -> list[str]:
-    import re
-    parts = re.split(r"[\.!?\u2026\n]+", text)
-    return [p.strip() for p in parts if p.strip()]
-
-def _tokenize_en(text: str) -> list[str]:
-    import re
-    s = text.lower()
-    toks = re.findall(r"[a-zA-Z']+", s)
-    sw = {
-        "the","a","an","and","or","but","if","then","else","on","in","at","to","for","from","of","with","without","by","as","is","are","was","were","be","been","this","that","these","those","it","its","we","our","you","your","i","me","my","they","them","their","he","she","his","her","not"
-    }
-    return [t for t in toks if t not in sw and len(t) > 1]
-
-def _tokenize_thai(text: str) -> list[str]:
-    import re
-    thai_seq = ''.join(ch if _is_thai_char(ch) or ch.isspace() else ' ' for ch in text)
-    raw = [t for t in re.split(r"\s+", thai_seq) if t]
-    if any(_is_thai_char(ch) for ch in ''.join(raw)) and sum(len(t) for t in raw) <= 4:
-        letters = [ch for ch in thai_seq if _is_thai_char(ch)]
-        grams = []
-        for n in (2,3):
-            for i in range(0, max(0, len(letters)-n+1)):
-                grams.append(''.join(letters[i:i+n]))
-        return grams
-    return raw
-
-def _bigrams(tokens: list[str]) -> list[str]:
-    out = []
-    for i in range(len(tokens)-1):
-        out.append(tokens[i] + ' ' + tokens[i+1])
-    return out
-
-@app.post("/analysis/mixed-content", response_model=MixedAnalysisResponse)
+@app.post("/analysis/mixed-content", response_model=MixedAnalysisResponse, response_model_exclude_none=True)
 async def analyze_mixed(req: MixedAnalysisRequest):
-    import collections
-    en_terms = collections.Counter()
-    th_terms = collections.Counter()
-    en_phr = collections.Counter()
-    th_phr = collections.Counter()
-    patterns = collections.Counter()
-    sent_stats = {"en":0,"th":0,"mixed":0}
-    switches = 0
-    for item in req.items:
-        text = item.text or ""
-        sentences = _split_sentences(text)
-        for s in sentences:
-            lang = _lang_of_text(s)
-            sent_stats[lang] = sent_stats.get(lang,0)+1
-            if lang == "en":
-                toks = _tokenize_en(s)
-                for t in toks:
-                    en_terms[t]+=1
-                for bg in _bigrams(toks):
-                    en_phr[bg]+=1
-            elif lang == "th":
-                toks = _tokenize_thai(s)
-                for t in toks:
-                    th_terms[t]+=1
-                for bg in _bigrams(toks):
-                    th_phr[bg]+=1
-            else:
-                en_t = _tokenize_en(s)
-                th_t = _tokenize_thai(s)
-                for t in en_t:
-                    en_terms[t]+=1
-                for t in th_t:
-                    th_terms[t]+=1
-                seq = []
-                for ch in s:
-                    if _is_thai_char(ch):
-                        seq.append('th')
-                    elif ("A"<=ch<="Z") or ("a"<=ch<="z"):
-                        seq.append('en')
-                for i in range(1,len(seq)):
-                    if seq[i]!=seq[i-1]:
-                        switches+=1
-                if en_t and th_t:
-                    patterns['TH→EN']+=1
-                    patterns['EN→TH']+=1
-                for bg in _bigrams(en_t):
-                    en_phr[bg]+=1
-                for bg in _bigrams(th_t):
-                    th_phr[bg]+=1
-    top_k = max(1, req.top_k)
-    top_en = [TermStat(term=t,count=c) for t,c in en_terms.most_common(top_k)]
-    top_th = [TermStat(term=t,count=c) for t,c in th_terms.most_common(top_k)]
-    en_ph = [TermStat(term=t,count=c) for t,c in en_phr.most_common(top_k)]
-    th_ph = [TermStat(term=t,count=c) for t,c in th_phr.most_common(top_k)]
+    width = sketch_width_for(req.sketch_width, req.sketch_epsilon) if req.approximate else None
+    key = await asyncio.to_thread(_analysis_cache_key, req, width)
+    cached = await _analysis_cache_get(key)
+    if cached is not None:
+        return cached
+    stats = await analyze_texts_async([item.text for item in req.items], sketch_width=width)
+    resp = _mixed_response(stats, req.top_k)
+    await _analysis_cache_set(key, resp)
+    return resp
+
+@app.post("/analysis/mixed-content/stream", response_model=MixedAnalysisResponse, response_model_exclude_none=True)
+async def analyze_mixed_stream(request: Request, top_k: int = 50, approximate: bool = False, sketch_width: Optional[int] = None, sketch_epsilon: Optional[float] = None):
+    """Same analysis as /analysis/mixed-content over an NDJSON body of {type, text} items."""
+    width = sketch_width_for(sketch_width, sketch_epsilon) if approximate else None
+    try:
+        stats = await analyze_ndjson(request.stream(), sketch_width=width)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"invalid_ndjson: {e}")
+    return _mixed_response(stats, top_k)
+
+def _term_stats(counter, top_k: int) -> list[TermStat]:
+    if isinstance(counter, SpaceSaving):
+        return [TermStat(term=t,count=c,error=counter.error(t)) for t,c in counter.most_common(top_k)]
+    return [TermStat(term=t,count=c) for t,c in counter.most_common(top_k)]
+
+def _mixed_response(stats: MixedCounters, top_k: int) -> MixedAnalysisResponse:
+    en_terms, th_terms, en_phr, th_phr, patterns = stats.en_terms, stats.th_terms, stats.en_phr, stats.th_phr, stats.patterns
+    sent_stats, switches = stats.sentences, stats.switches
+    top_k = max(1, top_k)
+    top_en = _term_stats(en_terms, top_k)
+    top_th = _term_stats(th_terms, top_k)
+    en_ph = _term_stats(en_phr, top_k)
+    th_ph = _term_stats(th_phr, top_k)
     pats = [BilingualPattern(pattern=t,count=c) for t,c in patterns.most_common(50)]
     totals = {
-        "total_tokens_en": sum(en_terms.values()),
-        "total_tokens_th": sum(th_terms.values()),
+        "total_tokens_en": en_terms.total(),
+        "total_tokens_th": th_terms.total(),
         "sum_top_en": sum(c.count for c in top_en),
         "sum_top_th": sum(c.count for c in top_th),
         "sentences_en": sent_stats.get("en",0),
         "sentences_th": sent_stats.get("th",0),
         "sentences_mixed": sent_stats.get("mixed",0)
     }
+    if stats.sketch_width:
+        totals["approximate"] = True
+        totals["sketch_width"] = stats.sketch_width
+        totals["max_error_en"] = en_terms.error_bound()
+        totals["max_error_th"] = th_terms.error_bound()
+        totals["max_error_en_phrases"] = en_phr.error_bound()
+        totals["max_error_th_phrases"] = th_phr.error_bound()
     mixing = MixingStats(en_only=sent_stats.get("en",0), th_only=sent_stats.get("th",0), mixed=sent_stats.get("mixed",0), switches=switches)
-    return MixedAnalysisResponse(top_en=top_en, top_th=top_th, en_phrases=en_ph, th_phrases=th_ph, bilingual_patterns=pats, mixing=mixing, totals=totals)
\ No newline at end of file
+    return MixedAnalysisResponse(top_en=top_en, top_th=top_th, en_phrases=en_ph, th_phrases=th_ph, bilingual_patterns=pats, mixing=mixing, totals=totals)
+
+# --- Per-tenant corpus aggregate ---
+
+CORPUS_KEEP_TERMS = _env_int("CORPUS_KEEP_TERMS", 20000)
+CORPUS_COMPACT_EVERY = _env_int("CORPUS_COMPACT_EVERY", 50000)
+
+async def _compact_corpus(db, tenant: str):
+    try:
+        pruned = await corpus.compact(db, tenant, CORPUS_KEEP_TERMS)
+        logging.info(f"corpus compacted tenant={tenant} pruned={pruned}")
+    except Exception as e:
+        logging.error(f"corpus compaction failed tenant={tenant} err={e}")
+
+@app.post("/analysis/corpus")
+async def corpus_ingest(payload: CorpusIngestRequest, background_tasks: BackgroundTasks, db=Depends(get_db), credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Fold new items into the tenant's stored term and phrase counts."""
+    claims = _claims(credentials)
+    tenant = payload.tenant_id or claims.get("tenant_id") or "default"
+    # Retrying with the same batch_id never counts a term twice, even after a partial failure.
+    batch_id = payload.batch_id or uuid4().hex
+    stats = await analyze_texts_async([item.text for item in payload.items])
+    try:
+        pending = await corpus.fold(db, tenant, stats, len(payload.items), batch_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"db_corpus_error: {e}", headers={"X-Batch-Id": batch_id})
+    compacting = pending >= CORPUS_COMPACT_EVERY
+    if compacting:
+        background_tasks.add_task(_compact_corpus, db, tenant)
+    return {"ok": True, "tenant_id": tenant, "items": len(payload.items), "batch_id": batch_id, "compacting": compacting}
+
+@app.get("/analysis/corpus", response_model=MixedAnalysisResponse, response_model_exclude_none=True)
+async def corpus_top(top_k: int = 50, tenant_id: Optional[str] = None, db=Depends(get_db), credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Current top-k of the tenant's stored aggregate, read without reprocessing."""
+    claims = _claims(credentials)
+    tenant = tenant_id or claims.get("tenant_id") or "default"
+    top_k = max(1, min(top_k, 1000))
+    try:
+        stats = await corpus.load(db, tenant, top_k)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"db_corpus_error: {e}")
+    return _mixed_response(stats, top_k)
+
+@app.post("/analysis/corpus/compact")
+async def corpus_compact(keep: Optional[int] = None, tenant_id: Optional[str] = None, db=Depends(get_db), credentials: HTTPAuthorizationCredentials = Depends(security)):
+    claims = _claims(credentials)
+    tenant = tenant_id or claims.get("tenant_id") or "default"
+    try:
+        pruned = await corpus.compact(db, tenant, keep or CORPUS_KEEP_TERMS)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"db_corpus_error: {e}")
+    return {"ok": True, "tenant_id": tenant, "pruned": pruned}
@@ -0,0 +1,66 @@
+try:
+    from prometheus_client import Counter, Gauge, Histogram, generate_latest, CollectorRegistry
+    METRICS_REGISTRY = CollectorRegistry()
+except Exception:
+    Counter = Gauge = Histogram = generate_latest = None
+    METRICS_REGISTRY = None
+
+
+def counter(name: str, doc: str, labels: list[str] | None = None):
+    if METRICS_REGISTRY is None:
+        return None
+    return Counter(name, doc, labels or [], registry=METRICS_REGISTRY)
+
+
+def gauge(name: str, doc: str, labels: list[str] | None = None):
+    if METRICS_REGISTRY is None:
+        return None
+    return Gauge(name, doc, labels or [], registry=METRICS_REGISTRY)
+
+
+def histogram(name: str, doc: str, labels: list[str] | None = None, buckets=None):
+    if METRICS_REGISTRY is None:
+        return None
+    if buckets is not None:
+        return Histogram(name, doc, labels or [], registry=METRICS_REGISTRY, buckets=buckets)
+    return Histogram(name, doc, labels or [], registry=METRICS_REGISTRY)
+
+
+def inc(metric, amount: float = 1, **labels) -> None:
+    if metric is None:
+        return
+    try:
+        (metric.labels(**labels) if labels else metric).inc(amount)
+    except Exception:
+        pass
+
+
+def dec(metric, amount: float = 1, **labels) -> None:
+    if metric is None:
+        return
+    try:
+        (metric.labels(**labels) if labels else metric).dec(amount)
+    except Exception:
+        pass
+
+
+def observe(metric, value: float, **labels) -> None:
+    if metric is None:
+        return
+    try:
+        (metric.labels(**labels) if labels else metric).observe(value)
+    except Exception:
+        pass
+
+
+def set_value(metric, value: float, **labels) -> None:
+    if metric is None:
+        return
+    try:
+        (metric.labels(**labels) if labels else metric).set(value)
+    except Exception:
+        pass
+
+
+HTTP_REQUESTS_TOTAL = counter("http_requests_total", "Total HTTP requests", ["method", "status"])
+HTTP_REQUEST_DURATION_SECONDS = histogram("http_request_duration_seconds", "HTTP request duration in seconds", ["method"])
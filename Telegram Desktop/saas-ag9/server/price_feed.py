@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+
+from server import metrics as prom
+from server.http_client import http_client
+
+
+COINGECKO_PRICE_URL = "https://api.coingecko.com/api/v3/simple/price"
+PRICE_REFRESH_SECONDS = prom.histogram("eth_price_refresh_seconds", "Latency of CoinGecko ETH price fetches", ["outcome"])
+
+
+class PriceRefresher:
+    """Fills ``state["eth_price_usd"]`` from CoinGecko in the background.
+
+    A price pushed through ``POST /events`` always wins: the feed only
+    writes while the value is unset or still the one it wrote itself, and
+    leaves ``last_updated`` (time of the last pushed event) alone. While a
+    pushed price holds the field CoinGecko is not queried at all. Runs on
+    the event loop, refreshing every ``interval`` seconds and backing
+    off exponentially (up to ``max_backoff``) while CoinGecko is failing.
+    Concurrent ``refresh()`` callers share a single outbound request.
+    """
+
+    def __init__(self, state: dict, interval: float = 60.0, max_backoff: float = 600.0) -> None:
+        self.state = state
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._written: float | None = None
+        self._inflight: asyncio.Future | None = None
+        self._task: asyncio.Task | None = None
+
+    async def _fetch(self) -> float | None:
+        r = await http_client("coingecko").get(COINGECKO_PRICE_URL, params={"ids": "ethereum", "vs_currencies": "usd"})
+        r.raise_for_status()
+        price = r.json().get("ethereum", {}).get("usd")
+        return float(price) if isinstance(price, (int, float)) else None
+
+    async def _refresh(self) -> float | None:
+        start = time.perf_counter()
+        try:
+            price = await self._fetch()
+        except Exception:
+            prom.observe(PRICE_REFRESH_SECONDS, time.perf_counter() - start, outcome="error")
+            raise
+        prom.observe(PRICE_REFRESH_SECONDS, time.perf_counter() - start, outcome="ok")
+        if price is not None and self.owns_price():
+            self.state["eth_price_usd"] = self._written = price
+        return price
+
+    def owns_price(self) -> bool:
+        """True while the stored price is unset or the one this feed wrote."""
+        current = self.state.get("eth_price_usd")
+        return current in (None, 0) or current == self._written
+
+    async def refresh(self) -> float | None:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.ensure_future(self._refresh())
+        return await asyncio.shield(self._inflight)
+
+    async def _run(self) -> None:
+        delay = self.interval
+        while True:
+            if not self.owns_price():
+                # A pushed price would win anyway; don't spend the rate-limited upstream.
+                await asyncio.sleep(self.interval)
+                continue
+            try:
+                await self.refresh()
+                delay = self.interval
+            except Exception as e:
+                delay = min(max(delay, 5.0) * 2, self.max_backoff)
+                logging.warning(f"eth price refresh failed, retrying in {int(delay)}s: {e}")
+            await asyncio.sleep(delay)
+
+    def start(self) -> None:
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
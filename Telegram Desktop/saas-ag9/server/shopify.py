@@ -0,0 +1,528 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import math
+import os
+import re
+import time
+from typing import Any, AsyncIterator
+
+from fastapi import HTTPException
+
+from server import metrics as prom
+from server.cache import TTLCache
+from server.http_client import http_client
+
+
+def _env(name: str, default: str | None = None) -> str | None:
+    v = os.getenv(name)
+    if v is None:
+        return default
+    s = v.strip()
+    if s.startswith("${") and s.endswith("}"):
+        return default
+    return s or default
+
+
+API_VERSION = "2024-10"
+
+PRODUCT_FIELDS = """
+    id
+    title
+    handle
+    descriptionHtml
+    vendor
+    productType
+    tags
+    status
+    totalInventory
+    variants(first: 50) {
+      edges {
+        node {
+          id
+          title
+          sku
+          barcode
+          price
+          inventoryQuantity
+          inventoryItem {
+            id
+            tracked
+            measurement {
+              weight {
+                unit
+                value
+              }
+            }
+          }
+        }
+      }
+    }
+    images(first: 10) {
+      edges {
+        node {
+          url
+          altText
+        }
+      }
+    }
+"""
+
+PRODUCT_QUERY = "query Product($id: ID!) { product(id: $id) {" + PRODUCT_FIELDS + "} }"
+NODES_QUERY = "query Products($ids: [ID!]!) { nodes(ids: $ids) { ... on Product {" + PRODUCT_FIELDS + "} } }"
+
+# Requested query cost of one product node above: the object itself plus
+# its variants (first: 50, each with an inventory item) and images (first: 10)
+# connections. Batches are sized so their sum stays under the single-query
+# limit (1000 points) and the 250-id cap on ``nodes``.
+PRODUCT_NODE_COST = 1 + (2 + 50 * 2) + (2 + 10)
+MAX_NODES_PER_QUERY = 250
+
+SHOPIFY_REQUEST_SECONDS = prom.histogram(
+    "shopify_request_seconds", "Latency of Shopify Admin API calls", ["operation", "outcome"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10),
+)
+SHOPIFY_THROTTLE_AVAILABLE = prom.gauge("shopify_throttle_available", "Estimated Shopify GraphQL cost points available")
+SHOPIFY_THROTTLE_WAIT_SECONDS = prom.histogram(
+    "shopify_throttle_wait_seconds", "Time spent waiting for Shopify query cost budget", ["lane"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
+SHOPIFY_THROTTLED_TOTAL = prom.counter("shopify_throttled_total", "Shopify calls rejected for lack of query cost budget", ["lane"])
+PRODUCT_CACHE_LOOKUPS = prom.counter("shopify_product_cache_lookups_total", "Shopify product cache lookups", ["result"])
+PRODUCT_CACHE_BYTES = prom.gauge("shopify_product_cache_bytes", "Bytes held by the Shopify product cache")
+
+
+PRODUCT_GID_RE = re.compile(r"gid://shopify/Product/[0-9]+")
+
+
+def product_gid(product_id: str | int) -> str:
+    s = str(product_id).strip()
+    return f"gid://shopify/Product/{s}" if s.isdigit() else s
+
+
+def valid_product_gid(gid: str) -> bool:
+    return PRODUCT_GID_RE.fullmatch(gid) is not None
+
+
+def configured() -> bool:
+    return bool(_env("SHOPIFY_SHOP") and _env("SHOPIFY_ACCESS_TOKEN"))
+
+
+class CostBucket:
+    """Client-side view of Shopify's GraphQL leaky bucket for one shop.
+
+    The bucket refills at ``restore_rate`` points per second up to
+    ``maximum``. Callers ``acquire`` the estimated cost before sending a
+    query, and every response's ``extensions.cost.throttleStatus`` resets the
+    view to Shopify's own numbers, which already include what other workers
+    spent. When ``attach``-ed to a Mongo collection the latest status is also
+    published there and picked up by workers that have not talked to Shopify
+    recently.
+
+    ``interactive`` callers go first: ``background`` callers wait while any
+    interactive caller is queued and always leave ``reserve`` of the bucket
+    untouched.
+    """
+
+    LANES = ("interactive", "background")
+
+    def __init__(self, maximum: float = 1000.0, restore_rate: float = 50.0, reserve: float = 0.2, share_interval: float = 1.0) -> None:
+        self.maximum = maximum
+        self.restore_rate = restore_rate
+        self.reserve = reserve
+        self.share_interval = share_interval
+        self.store = None
+        self._available = maximum
+        self._at = time.monotonic()
+        self._status_time = 0.0
+        self._published_at = 0.0
+        self._pulled_at = 0.0
+        self._waiting = dict.fromkeys(self.LANES, 0)
+        self._cond: asyncio.Condition | None = None
+
+    def attach(self, collection) -> None:
+        self.store = collection if self.share_interval > 0 else None
+
+    def available(self, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        return min(self.maximum, self._available + (now - self._at) * self.restore_rate)
+
+    def wait_time(self, cost: float, lane: str = "interactive") -> float:
+        """Seconds until ``cost`` points can be spent in ``lane``."""
+        need = cost + (self.reserve * self.maximum if lane == "background" else 0.0)
+        need = min(need, self.maximum)
+        return max(0.0, (need - self.available()) / max(self.restore_rate, 1e-3))
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self, cost: float, lane: str = "interactive", timeout: float = 5.0) -> None:
+        """Wait until ``cost`` points are available, then spend them.
+
+        Raises a 429 ``HTTPException`` with ``Retry-After`` if that would
+        take longer than ``timeout`` seconds.
+        """
+        lane = lane if lane in self._waiting else "background"
+        deadline = time.monotonic() + timeout
+        started = time.monotonic()
+        self._waiting[lane] += 1
+        try:
+            while True:
+                await self._pull_shared()
+                blocked = lane == "background" and self._waiting["interactive"] > 0
+                wait = self.wait_time(cost, lane)
+                if not blocked and wait <= 0:
+                    now = time.monotonic()
+                    self._available = self.available(now) - cost
+                    self._at = now
+                    prom.observe(SHOPIFY_THROTTLE_WAIT_SECONDS, now - started, lane=lane)
+                    prom.set_value(SHOPIFY_THROTTLE_AVAILABLE, self._available)
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or wait > remaining:
+                    prom.inc(SHOPIFY_THROTTLED_TOTAL, lane=lane)
+                    retry_after = max(1, math.ceil(wait or self.wait_time(cost, "interactive") or 1))
+                    raise HTTPException(status_code=429, detail="shopify_throttled", headers={"Retry-After": str(retry_after)})
+                cond = self._condition()
+                async with cond:
+                    try:
+                        await asyncio.wait_for(cond.wait(), min(max(wait, 0.05), remaining))
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self._waiting[lane] -= 1
+            if lane == "interactive" and self._waiting["interactive"] == 0:
+                await self._notify()
+
+    async def _notify(self) -> None:
+        cond = self._condition()
+        async with cond:
+            cond.notify_all()
+
+    def _apply(self, status: dict, at: float) -> None:
+        self.maximum = float(status.get("maximumAvailable") or self.maximum)
+        self.restore_rate = float(status.get("restoreRate") or self.restore_rate)
+        available = float(status.get("currentlyAvailable", self._available))
+        # Shared status may be a moment old; credit the refill since it was taken.
+        self._available = min(self.maximum, available + max(0.0, time.time() - at) * self.restore_rate)
+        self._at = time.monotonic()
+        self._status_time = at
+        prom.set_value(SHOPIFY_THROTTLE_AVAILABLE, self._available)
+
+    async def sync(self, status: dict | None) -> None:
+        """Adopt a ``throttleStatus`` block from a GraphQL response."""
+        if not status:
+            return
+        at = time.time()
+        self._apply(status, at)
+        await self._notify()
+        if self.store is not None and at - self._published_at >= self.share_interval:
+            self._published_at = at
+            doc = {"status": status, "at": at}
+            try:
+                await self.store.update_one({"_id": _env("SHOPIFY_SHOP") or "default"}, {"$set": doc}, upsert=True)
+            except Exception as e:
+                logging.warning(f"shopify throttle publish failed: {e}")
+
+    async def _pull_shared(self) -> None:
+        now = time.time()
+        if self.store is None or now - max(self._status_time, self._pulled_at) < self.share_interval:
+            return
+        self._pulled_at = now
+        try:
+            doc = await self.store.find_one({"_id": _env("SHOPIFY_SHOP") or "default"})
+        except Exception as e:
+            logging.warning(f"shopify throttle read failed: {e}")
+            return
+        if doc and doc.get("at", 0) > self._status_time:
+            self._apply(doc.get("status") or {}, doc["at"])
+
+
+THROTTLE = CostBucket(
+    reserve=float(_env("SHOPIFY_THROTTLE_RESERVE", "0.2")),
+    share_interval=float(_env("SHOPIFY_THROTTLE_SHARE_SECONDS", "1")),
+)
+LANE_TIMEOUTS = {
+    "interactive": float(_env("SHOPIFY_THROTTLE_MAX_WAIT", "5")),
+    "background": float(_env("SHOPIFY_THROTTLE_BACKGROUND_MAX_WAIT", "120")),
+}
+
+
+def _throttled(body: dict) -> bool:
+    return any(((e or {}).get("extensions") or {}).get("code") == "THROTTLED" for e in body.get("errors") or [])
+
+
+async def graphql(query: str, variables: dict | None = None, operation: str = "query", cost: float = 10.0, lane: str = "interactive") -> dict:
+    """POST a GraphQL document to the Admin API and return the decoded body.
+
+    ``cost`` is the estimated query cost reserved from ``THROTTLE`` before
+    sending; THROTTLED responses are retried once the bucket has refilled,
+    within the lane's wait budget.
+    """
+    shop = _env("SHOPIFY_SHOP")
+    token = _env("SHOPIFY_ACCESS_TOKEN")
+    if not shop or not token:
+        raise HTTPException(status_code=500, detail="Shopify not configured")
+    url = f"https://{shop}/admin/api/{API_VERSION}/graphql.json"
+    headers = {"Content-Type": "application/json", "X-Shopify-Access-Token": token}
+    deadline = time.monotonic() + LANE_TIMEOUTS.get(lane, LANE_TIMEOUTS["background"])
+    while True:
+        await THROTTLE.acquire(cost, lane, timeout=max(0.0, deadline - time.monotonic()))
+        start = time.perf_counter()
+        try:
+            r = await http_client("shopify").post(url, json={"query": query, "variables": variables or {}}, headers=headers)
+        except Exception as e:
+            prom.observe(SHOPIFY_REQUEST_SECONDS, time.perf_counter() - start, operation=operation, outcome="error")
+            raise HTTPException(status_code=502, detail=f"Shopify request failed: {e}")
+        if r.status_code == 429:
+            prom.observe(SHOPIFY_REQUEST_SECONDS, time.perf_counter() - start, operation=operation, outcome="throttled")
+            await THROTTLE.sync({"currentlyAvailable": 0})
+            continue
+        body = r.json() if r.is_success else {}
+        cost_info = (body.get("extensions") or {}).get("cost") or {}
+        await THROTTLE.sync(cost_info.get("throttleStatus"))
+        if _throttled(body):
+            prom.observe(SHOPIFY_REQUEST_SECONDS, time.perf_counter() - start, operation=operation, outcome="throttled")
+            cost = float(cost_info.get("requestedQueryCost") or cost)
+            continue
+        prom.observe(SHOPIFY_REQUEST_SECONDS, time.perf_counter() - start, operation=operation, outcome="ok" if r.is_success else str(r.status_code))
+        if not r.is_success:
+            raise HTTPException(status_code=r.status_code, detail=r.text)
+        return body
+
+
+async def fetch_product(gid: str) -> dict | None:
+    """The product, or None if Shopify says it does not exist.
+
+    A null product that comes with GraphQL ``errors`` is not an answer and
+    raises a 502 instead, so it is never cached as missing.
+    """
+    body = await graphql(PRODUCT_QUERY, {"id": gid}, operation="product", cost=PRODUCT_NODE_COST)
+    product = (body.get("data") or {}).get("product")
+    if product is None and body.get("errors"):
+        raise HTTPException(status_code=502, detail=f"shopify_graphql_error: {body['errors'][0].get('message')}")
+    return product
+
+
+async def fetch_products(gids: list[str]) -> dict[str, dict | None]:
+    """Resolve several products with one ``nodes`` query.
+
+    Returns only the ids Shopify definitively answered: the product, or
+    None for one that does not exist. Ids whose node failed (an error whose
+    ``path`` points at it, or an error without a path while the node is
+    null) are left out, as are all ids if ``nodes`` is missing altogether.
+    """
+    body = await graphql(NODES_QUERY, {"ids": gids}, operation="nodes", cost=PRODUCT_NODE_COST * len(gids))
+    nodes = (body.get("data") or {}).get("nodes")
+    errors = body.get("errors") or []
+    if not isinstance(nodes, list) or len(nodes) != len(gids):
+        if errors:
+            logging.warning(f"shopify nodes query returned no data: {errors[0].get('message')}")
+        return {}
+    failed: set[int] = set()
+    unattributed = False
+    for err in errors:
+        path = err.get("path") or []
+        if len(path) >= 2 and path[0] == "nodes" and isinstance(path[1], int):
+            failed.add(path[1])
+        else:
+            unattributed = True
+    answered: dict[str, dict | None] = {}
+    for i, (gid, node) in enumerate(zip(gids, nodes)):
+        if i in failed or (node is None and unattributed):
+            continue
+        answered[gid] = node
+    return answered
+
+
+def batch_size(max_cost: int) -> int:
+    return max(1, min(MAX_NODES_PER_QUERY, max_cost // PRODUCT_NODE_COST))
+
+
+class ProductCache:
+    """Product documents keyed by GID, served stale-while-revalidate.
+
+    Entries are fresh for ``ttl`` seconds; for a further ``stale_ttl`` they
+    are still returned immediately while one background fetch refreshes
+    them. Unknown products are remembered for ``missing_ttl`` so repeated
+    lookups of a bad id do not reach Shopify. Concurrent misses for the same
+    GID share one upstream request, and ``invalidate`` (driven by product
+    webhooks) discards both the entry and any fetch already in flight.
+    """
+
+    def __init__(self, ttl: float = 60.0, stale_ttl: float = 600.0, missing_ttl: float = 30.0, max_entries: int = 5000, max_bytes: int = 32 * 1024 * 1024) -> None:
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.missing_ttl = missing_ttl
+        self.entries = TTLCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl + stale_ttl)
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._generation: dict[str, int] = {}
+        # Background revalidations, held so the loop cannot collect them mid-flight.
+        self._tasks: set[asyncio.Task] = set()
+
+    def _store(self, gid: str, product: dict | None) -> None:
+        if product is None:
+            self.entries.set(gid, (time.monotonic() + self.missing_ttl, None), size=len(gid), ttl=self.missing_ttl)
+        else:
+            size = len(json.dumps(product, separators=(",", ":")))
+            self.entries.set(gid, (time.monotonic() + self.ttl, product), size=size)
+        prom.set_value(PRODUCT_CACHE_BYTES, self.entries.nbytes)
+
+    async def _fetch(self, gid: str) -> dict | None:
+        generation = self._generation.get(gid, 0)
+        try:
+            product = await fetch_product(gid)
+            if self._generation.get(gid, 0) == generation:
+                self._store(gid, product)
+            return product
+        finally:
+            if self._inflight.get(gid) is asyncio.current_task():
+                del self._inflight[gid]
+
+    def _refresh(self, gid: str) -> asyncio.Future:
+        fut = self._inflight.get(gid)
+        if fut is None:
+            fut = self._inflight[gid] = asyncio.ensure_future(self._fetch(gid))
+        return fut
+
+    async def _revalidate(self, gid: str) -> None:
+        try:
+            await self._refresh(gid)
+        except Exception as e:
+            logging.warning(f"shopify product refresh failed for {gid}: {getattr(e, 'detail', None) or repr(e)}")
+
+    def lookup(self, gid: str) -> tuple[dict | None, str]:
+        """Return ``(product or None, "hit" | "stale" | "miss")`` without fetching."""
+        entry = self.entries.get(gid)
+        if entry is None:
+            prom.inc(PRODUCT_CACHE_LOOKUPS, result="miss")
+            return None, "miss"
+        fresh_until, product = entry
+        status = "hit" if time.monotonic() < fresh_until else "stale"
+        prom.inc(PRODUCT_CACHE_LOOKUPS, result=status)
+        return product, status
+
+    async def get(self, gid: str) -> tuple[dict | None, str]:
+        """Return ``(product or None, "hit" | "stale" | "miss")``."""
+        product, status = self.lookup(gid)
+        if status == "stale" and gid not in self._inflight:
+            task = asyncio.create_task(self._revalidate(gid))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if status == "miss":
+            product = await asyncio.shield(self._refresh(gid))
+        return product, status
+
+    async def get_many(self, gids: list[str], max_cost: int = 1000, concurrency: int = 4) -> AsyncIterator[list[dict]]:
+        """Yield ``{id, product, cache}`` rows for ``gids`` as they become available.
+
+        Cached products come back first in one group. Misses are then
+        fetched with ``nodes`` queries of at most ``max_cost`` points each,
+        ``concurrency`` at a time, and every query's rows are yielded as
+        soon as it completes. Stale entries are served immediately and
+        refreshed by the same queries. Malformed ids come back as
+        ``invalid`` without being queried, and ids a query did not answer
+        as ``error`` without being cached.
+        """
+        cached, fetch, seen = [], [], set()
+        for gid in gids:
+            if gid in seen:
+                continue
+            seen.add(gid)
+            if not valid_product_gid(gid):
+                # A malformed id fails the whole ``nodes`` query; keep it out of the batches.
+                cached.append({"id": gid, "product": None, "cache": "invalid"})
+                continue
+            product, status = self.lookup(gid)
+            if status != "miss":
+                cached.append({"id": gid, "product": product, "cache": status})
+            if status != "hit":
+                fetch.append(gid)
+        if cached:
+            yield cached
+        if not fetch:
+            return
+        stale = {row["id"] for row in cached}
+        size = batch_size(max_cost)
+        sem = asyncio.Semaphore(max(1, concurrency))
+
+        async def run(chunk: list[str]) -> list[dict]:
+            generations = {gid: self._generation.get(gid, 0) for gid in chunk}
+            async with sem:
+                try:
+                    products = await fetch_products(chunk)
+                except HTTPException as e:
+                    logging.warning(f"shopify nodes query failed for {len(chunk)} ids: {e.detail}")
+                    return [{"id": gid, "product": None, "cache": "error"} for gid in chunk if gid not in stale]
+            for gid, product in products.items():
+                if self._generation.get(gid, 0) == generations[gid]:
+                    self.put(gid, product)
+            return [
+                {"id": gid, "product": products[gid], "cache": "miss"} if gid in products else {"id": gid, "product": None, "cache": "error"}
+                for gid in chunk if gid not in stale
+            ]
+
+        tasks = [asyncio.ensure_future(run(fetch[i:i + size])) for i in range(0, len(fetch), size)]
+        try:
+            for done in asyncio.as_completed(tasks):
+                rows = await done
+                if rows:
+                    yield rows
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    def put(self, gid: str, product: dict | None) -> None:
+        """Store a product fetched elsewhere (e.g. as part of a batch)."""
+        if gid not in self._inflight:
+            self._store(gid, product)
+
+    def invalidate(self, gid: str) -> bool:
+        if len(self._generation) > 4 * self.entries.max_entries:
+            self._generation = {k: v for k, v in self._generation.items() if k in self._inflight}
+        self._generation[gid] = self._generation.get(gid, 0) + 1
+        self._inflight.pop(gid, None)
+        found = self.entries.pop(gid) is not None
+        prom.set_value(PRODUCT_CACHE_BYTES, self.entries.nbytes)
+        return found
+
+    def clear(self) -> None:
+        self.entries.clear()
+        prom.set_value(PRODUCT_CACHE_BYTES, 0)
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+PRODUCT_CACHE = ProductCache(
+    ttl=float(_env("SHOPIFY_PRODUCT_CACHE_TTL", "60")),
+    stale_ttl=float(_env("SHOPIFY_PRODUCT_CACHE_STALE_TTL", "600")),
+    max_entries=int(_env("SHOPIFY_PRODUCT_CACHE_MAX_ENTRIES", "5000")),
+    max_bytes=int(_env("SHOPIFY_PRODUCT_CACHE_MAX_MB", "32")) * 1024 * 1024,
+)
+
+
+def verify_webhook(body: bytes, signature: str | None) -> None:
+    """Check ``X-Shopify-Hmac-Sha256`` against ``SHOPIFY_WEBHOOK_SECRET``."""
+    secret = _env("SHOPIFY_WEBHOOK_SECRET")
+    if not secret:
+        raise HTTPException(status_code=500, detail="shopify_webhook_not_configured")
+    expected = base64.b64encode(hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("ascii")
+    if not signature or not hmac.compare_digest(expected, signature.strip()):
+        raise HTTPException(status_code=401, detail="invalid_webhook_signature")
+
+
+def webhook_product_gid(payload: dict[str, Any]) -> str | None:
+    gid = payload.get("admin_graphql_api_id")
+    if isinstance(gid, str) and gid.startswith("gid://shopify/Product/"):
+        return gid
+    pid = payload.get("id")
+    return product_gid(pid) if pid is not None else None
@@ -0,0 +1,106 @@
+import heapq
+from typing import Iterable
+
+
+class SpaceSaving:
+    """Space-Saving heavy-hitters summary with at most ``capacity`` keys.
+
+    Counts never underestimate; each reported count exceeds the true count by
+    at most ``error(key)``, which is itself bounded by ``total() / capacity``.
+    Exposes the subset of the ``collections.Counter`` API the analysis code
+    uses (update, most_common, total) so the two are interchangeable.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = max(1, int(capacity))
+        self._counts: dict[str, int] = {}
+        self._errors: dict[str, int] = {}
+        # One (count, key) entry per tracked key. Entries go stale when a key is
+        # incremented and are only refreshed when they surface at the top.
+        self._heap: list[tuple[int, str]] = []
+        self._total = 0
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._counts
+
+    def __getitem__(self, key: str) -> int:
+        return self._counts.get(key, 0)
+
+    def total(self) -> int:
+        return self._total
+
+    def error(self, key: str) -> int:
+        return self._errors.get(key, 0)
+
+    def error_bound(self) -> int:
+        return self._total // self.capacity
+
+    def min_count(self) -> int:
+        """Smallest tracked count when full; any untracked key has at most this many."""
+        if len(self._counts) < self.capacity:
+            return 0
+        heap, counts = self._heap, self._counts
+        while True:
+            c, k = heap[0]
+            cur = counts[k]
+            if cur == c:
+                return c
+            heapq.heapreplace(heap, (cur, k))
+
+    def add(self, key: str, n: int = 1, err: int = 0) -> None:
+        self._total += n
+        counts = self._counts
+        if key in counts:
+            counts[key] += n
+            self._errors[key] += err
+            return
+        if len(counts) < self.capacity:
+            counts[key] = n
+            self._errors[key] = err
+            heapq.heappush(self._heap, (n, key))
+            return
+        floor = self.min_count()
+        _, victim = heapq.heapreplace(self._heap, (floor + n, key))
+        del counts[victim]
+        del self._errors[victim]
+        counts[key] = floor + n
+        self._errors[key] = floor + err
+
+    def update(self, items: "Iterable[str] | SpaceSaving") -> None:
+        if isinstance(items, SpaceSaving):
+            self.merge(items)
+            return
+        counts = self._counts
+        for key in items:
+            if key in counts:
+                counts[key] += 1
+                self._total += 1
+            else:
+                self.add(key)
+
+    def merge(self, other: "SpaceSaving") -> "SpaceSaving":
+        """Fold another summary in, keeping the combined guarantees (Agarwal et al.)."""
+        a_floor, b_floor = self.min_count(), other.min_count()
+        merged: dict[str, tuple[int, int]] = {}
+        for k, c in self._counts.items():
+            if k in other._counts:
+                merged[k] = (c + other._counts[k], self._errors[k] + other._errors[k])
+            else:
+                merged[k] = (c + b_floor, self._errors[k] + b_floor)
+        for k, c in other._counts.items():
+            if k not in merged:
+                merged[k] = (c + a_floor, other._errors[k] + a_floor)
+        keep = heapq.nlargest(self.capacity, merged.items(), key=lambda kv: kv[1][0]) if len(merged) > self.capacity else merged.items()
+        self._counts = {k: v[0] for k, v in keep}
+        self._errors = {k: v[1] for k, v in keep}
+        self._heap = [(c, k) for k, c in self._counts.items()]
+        heapq.heapify(self._heap)
+        self._total += other._total
+        return self
+
+    def most_common(self, n: int | None = None) -> list[tuple[str, int]]:
+        items = sorted(self._counts.items(), key=lambda kv: kv[1], reverse=True)
+        return items if n is None else items[:n]